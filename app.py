@@ -1,24 +1,43 @@
+import hashlib
 import os
+import threading
+import time
 
 from dateutil.parser import parse as date_parse
 
 from datetime import timezone, datetime
 
-from flask import Flask, request, make_response, render_template, Response, g, jsonify
+from flask import (Flask, request, make_response, render_template, Response, g, jsonify,
+                   stream_with_context, send_file, has_request_context)
 
 from flask_cors import CORS, cross_origin
 
-from flask_weasyprint import HTML, render_pdf
+from werkzeug.http import is_resource_modified
 
-from functools import wraps
+from functools import partial, wraps
 
-import mysql.connector
-import bcrypt
+from operator import itemgetter
 
+import auth
+import cards
 import config
+import db
+import events
+import jobs
+import listing
+import loans
+import metrics
+import qr
+import reservations
+import search
+import versions
+import workers
+from cache import TTLCache
 from util import (encode_json,
+                  encode_json_envelope,
+                  set_json_backend,
+                  fetch_chunks,
                   parse_range,
-                  make_qr,
                   dict_dates_to_utc,
                   SQL_one_line)
 
@@ -34,29 +53,200 @@ APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 
 QR_CODE_PATH = os.path.join(APP_ROOT, 'static', 'img', 'qr')
 
+SPOOL_PATH = os.path.join(APP_ROOT, config.jobs.get('spool', 'spool'))
+
+os.makedirs(SPOOL_PATH, exist_ok=True)
+
+# rows fetched and encoded at a time by make_streaming_response
+STREAM_CHUNK_SIZE = 500
+
+log.info('JSON backend: ' + set_json_backend(config.encoding.get('json_backend', 'stdlib')))
+
+job_registry = jobs.JobRegistry(os.path.join(SPOOL_PATH, 'jobs.sqlite'),
+                               keep=config.jobs.get('keep', 100),
+                               runners=config.jobs.get('runners', 2))
+
+card_renderer = cards.CardRenderer(
+    cards.PDFCache(os.path.join(SPOOL_PATH, 'pdf'), max_bytes=config.pdf.get('cache_bytes', 200 * 1024 * 1024)),
+    os.path.join(APP_ROOT, 'templates'), os.path.join(APP_ROOT, 'static'),
+    chunk_pages=config.pdf.get('chunk_pages', 8))
+
+qr_store = qr.QRStore(QR_CODE_PATH, cache_size=config.qr.get('cache_size', 512))
+
+table_versions = versions.TableVersions(os.path.join(SPOOL_PATH, 'versions'))
+
+event_log = events.EventLog(os.path.join(SPOOL_PATH, 'events.sqlite'), table_versions,
+                            history=config.events.get('history', 1000))
+
+event_bus = events.EventBus(event_log, queue_size=config.events.get('queue_size', 100),
+                            poll=config.events.get('poll', 0.25))
+
+response_cache = TTLCache(maxsize=config.response_cache.get('size', 256),
+                          ttl=config.response_cache.get('ttl', 60))
+
+reservation_index = reservations.ReservationIndex(refresh=config.reservation_index.get('refresh', 60))
+
+user_index = search.UserSearch(refresh=config.search.get('refresh', 300))
+
+suggestions = {
+    'user': search.Suggestions('user', ('id', 'email', 'fname', 'lname'), search.user_terms,
+                               refresh=config.search.get('refresh', 300)),
+    'device': search.Suggestions('device', ('id', 'serial_no', 'type'), search.device_terms,
+                                 refresh=config.search.get('refresh', 300))
+}
+
 app = Flask(__name__)
 
 CORS(app)
 
-udp.go()
+
+# endpoints which never touch the database don't take a pooled connection
+NO_DATABASE = {'static', 'qr_code', 'app_config', 'log_endpoint',
+               'generate_qr', 'job_status', 'job_download', 'suggest', 'events_feed',
+               'metrics_endpoint', 'user_search'}
+
+
+# tables changed by each endpoint's writes, bumped in table_versions once
+# the request is done
+WRITES = {
+    'user': ('user',),
+    'user_batch': ('user',),
+    'one_user': ('user', 'device', 'class_registration', 'reservation',
+                 'device_type_privilage', 'lateness'),
+    'user_privilege': ('device_type_privilage',),
+    'device': ('device',),
+    'one_device': ('device',),
+    'device_active': ('device',),
+    'loan': ('device',),
+    'loan_batch': ('device',),
+    'reservation': ('reservation',),
+    'one_reservation': ('reservation',),
+    'all_class': ('class',),
+    'one_class': ('class', 'class_registration', 'reservation'),
+    'class_register': ('class_registration',),
+    'lateness': ('lateness',)
+}
+
+# tables read by each JSON GET endpoint. Their responses get an ETag and
+# Last-Modified from table_versions, so a client polling with
+# If-None-Match or If-Modified-Since gets a 304 without any query
+READS = {
+    'user': ('user',),
+    'one_user': ('user', 'device', 'device_type_privilage', 'class', 'class_registration'),
+    'user_search': ('user',),
+    'suggest': ('user', 'device'),
+    'device': ('device',),
+    'one_device': ('device',),
+    'device_type': ('device',),
+    'reservation': ('reservation',),
+    'reservation_availability': ('reservation', 'device'),
+    'one_reservation': ('reservation',),
+    'all_class': ('class',),
+    'one_class': ('class', 'class_registration', 'user'),
+    'lateness': ('lateness',),
+    'app_config': ()
+}
+
+# endpoints of READS whose whole responses are kept in response_cache. Not
+# the streamed lists, which would be read into memory to be kept; those
+# rely on their ETags instead
+CACHED = {'device_type', 'app_config'}
+
+
+def validators(endpoint, full_path, versions, changed_at):
+    """ (etag, last_modified) for a GET from the versions of the tables it
+    reads and when they last changed. The ETag also changes every config.response_cache['ttl']
+    seconds, so changes made outside the app are seen in the end.
+
+    Last-Modified only has whole seconds, so clients sending If-None-Match
+    as well are answered by the ETag alone. It is None while the second of
+    the latest change is still going, as a write later in that second
+    would get the same Last-Modified and be missed.
+    """
+    now = time.time()
+    ttl = config.response_cache.get('ttl', 60)
+    window = int(now // ttl) if ttl else 0
+
+    key = repr((versions, window, endpoint, full_path))
+    etag = hashlib.sha1(key.encode()).hexdigest()
+
+    if int(changed_at) >= int(now):
+        return etag, None
+    return etag, datetime.fromtimestamp(int(changed_at), tz=timezone.utc)
 
 
 @app.before_request
 def before_request():
+    g.started = time.perf_counter()
+
+    if request.method in ('GET', 'HEAD') and request.endpoint in READS:
+        # read before the database is, so a write in between can only
+        # make the response look older than it is
+        tables = READS[request.endpoint]
+        g.versions = table_versions.get(*tables)
+        g.changed_at = table_versions.changed_at(*tables)
+
+        g.etag, g.last_modified = validators(request.endpoint, request.full_path, g.versions, g.changed_at)
+        if not is_resource_modified(request.environ, etag=g.etag, last_modified=g.last_modified):
+            return Response(status=304)
+
+        hit = response_cache.get((request.endpoint, request.full_path))
+        if request.endpoint in CACHED and hit is not None and hit[0] == g.versions:
+            g.cache_hit = True
+            _, data, mimetype = hit
+            return Response(data, mimetype=mimetype)
+
+    if request.endpoint in NO_DATABASE:
+        return
+
     try:
         g.cnx, g.cursor = get_database()
         
-    except Exception:
-        make_failed_response(code=503, error_message="No database connection could be established.")
+    except Exception as e:
+        log.error('Could not get a database connection: ' + str(e))
+        return make_failed_response(code=503, error_message="No database connection could be established.")
+
+
+@app.after_request
+def after_request(response):
+    # streamed bodies are still being sent, so this is the time to the headers
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.get('started', time.perf_counter()),
+                                    request.endpoint or 'none', request.method, response.status_code)
+
+    # a rejected write changed nothing, so it keeps ETags and indexes current
+    if (request.method not in ('GET', 'HEAD', 'OPTIONS') and request.endpoint in WRITES
+            and response.status_code < 400):
+        table_versions.bump(*WRITES[request.endpoint])
+
+    if 'versions' in g and response.status_code in (200, 304):
+        if (response.status_code == 200 and request.endpoint in CACHED
+                and not response.is_streamed and not g.get('cache_hit')):
+            response_cache.set((request.endpoint, request.full_path),
+                               (g.versions, response.get_data(), response.mimetype))
+
+        response.set_etag(g.etag)
+        if g.last_modified is not None:
+            response.last_modified = g.last_modified
+        response.cache_control.no_cache = True
+
+    return response
+
 
 @app.teardown_request
 def teardown_request(exception):
+    cnx = g.pop('cnx', None)
+    cursor = g.pop('cursor', None)
+
+    if cnx is None:
+        return
+
     try:
-        g.cursor.close()
-        g.cnx.close()
-    except AttributeError:
+        cursor.close()
+    except Exception:
         pass
 
+    db.get_pool().checkin(cnx)
+
 
 
 def check_auth(username, password):
@@ -64,8 +254,7 @@ def check_auth(username, password):
     password combination is valid.
     """
     
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cursor = g.cursor
    
     # user name may be the user's id or their email
     if username.isdigit():
@@ -77,16 +266,35 @@ def check_auth(username, password):
                             WHERE email = %s """, (username,))
 
     rows = cursor.fetchall()
-    
-    g.user = rows[0]
         
     if not len(rows):
         return False
+    
+    g.user = rows[0]
                             
-    if bcrypt.checkpw(password.encode('ascii'), rows[0]['password'].encode('ascii')):
-        return True
-    else:
+    return auth.check_password(rows[0], password)
+
+
+def check_token(token):
+    """Checks a session token from POST /api/v1/token, avoiding bcrypt.
+    """
+    
+    data = auth.load_token(token)
+    
+    if data is None:
+        return False
+    
+    g.cursor.execute(""" SELECT * FROM user
+                         WHERE id = %s """, (data['id'],))
+    
+    rows = g.cursor.fetchall()
+    
+    if not len(rows) or not auth.token_matches(data, rows[0]):
         return False
+    
+    g.user = rows[0]
+    
+    return True
 
 
 def authenticate():
@@ -100,21 +308,31 @@ def authenticate():
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            if not check_token(header[len('Bearer '):].strip()):
+                return authenticate()
+            return f(*args, **kwargs)
+        
+        credentials = request.authorization
+        if not credentials or not check_auth(credentials.username, credentials.password):
             return authenticate()
         return f(*args, **kwargs)
     return decorated
 
 
 def get_database():
-    """ returns a connection and cursor
+    """ checks a connection out of the pool and returns it with a cursor
 
     e.g. cnx, cursor = get_database()
+
+    The connection must be given back with db.get_pool().checkin(cnx),
+    teardown_request does this for g.cnx.
     """
 
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(named_tuple=True)
+    cnx = db.get_pool().checkout()
+    endpoint = request.endpoint if has_request_context() else None
+    cursor = metrics.TimedCursor(cnx.cursor(buffered=True, dictionary=True), endpoint)
 
     return cnx, cursor
 
@@ -126,6 +344,110 @@ def make_success_response(data, code=200, mimetype='application/json'):
     return resp
 
 
+def stream_cursor(dictionary=True):
+    """ an unbuffered cursor on g.cnx, which reads rows from the server as
+    they are fetched rather than all at once
+    """
+    return metrics.TimedCursor(g.cnx.cursor(dictionary=dictionary), request.endpoint)
+
+
+def release_database(*cursors):
+    """ takes g.cnx out of the request for a response body which reads it
+    after the view returns, as teardown_request runs before the body is
+    sent. Returns release(), which closes cursors and g.cursor and gives
+    the connection back, and may be called more than once.
+    """
+    cnx = g.pop('cnx')
+    cursors += (g.pop('cursor'),)
+    released = []
+    
+    def release():
+        if released:
+            return
+        released.append(True)
+        
+        for cursor in cursors:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        
+        db.get_pool().checkin(cnx)
+    
+    return release
+
+
+def make_streaming_response(cursor, transform=None, limit=None, columnar=False,
+                            code=200, mimetype='application/json'):
+    """ like make_success_response(cursor.fetchall()), but rows are fetched,
+    encoded and sent STREAM_CHUNK_SIZE at a time so memory stays flat
+    
+    cursor must be on g.cnx, which the response keeps until its rows are
+    sent, or it is closed unread, and then gives back to the pool.
+    
+    transform(rows) may change each chunk of rows and returns it. With a
+    limit, at most that many rows are sent and the envelope gains a "next"
+    cursor (see listing.Page).
+    
+    columnar is for tuple cursors: the column names are sent once, followed
+    by each row as an array.
+    """
+    release = release_database(cursor)
+    
+    def chunks():
+        try:
+            for rows in fetch_chunks(cursor, STREAM_CHUNK_SIZE):
+                if transform is not None:
+                    rows = transform(rows)
+                yield rows
+        finally:
+            release()
+    
+    if columnar:
+        columns = cursor.column_names
+        # paged queries always select id
+        row_id = itemgetter(columns.index('id')) if 'id' in columns else None
+        page = listing.Page(chunks(), limit, row_id=row_id)
+    else:
+        columns = None
+        page = listing.Page(chunks(), limit)
+    
+    response = Response(encode_json_envelope(page, extra=page.envelope, columns=columns), code, mimetype=mimetype)
+    response.call_on_close(release)
+    return response
+
+
+def make_list_response(query):
+    """ streams the rows of a list endpoint, paged, projected and filtered
+    by the request's query string through a listing.ListQuery
+    
+    ?format=columnar sends column names once and rows as arrays, read from
+    a tuple cursor instead of building a dict per row
+    """
+    columnar = request.args.get('format', 'json') == 'columnar'
+    
+    if request.args.get('format', 'json') not in ('json', 'columnar'):
+        return make_failed_response('format must be json or columnar')
+    
+    try:
+        sql, params, limit = query.build(request.args)
+    except ValueError as e:
+        return make_failed_response(str(e))
+    
+    cursor = stream_cursor(dictionary=not columnar)
+    
+    try:
+        cursor.execute(sql, params)
+    except Exception as e:
+        cursor.close()
+        return make_failed_response(str(e))
+    
+    columns = cursor.column_names
+    
+    return make_streaming_response(cursor, transform=lambda rows: query.convert(rows, columns),
+                                   limit=limit, columnar=columnar)
+
+
 def make_failed_response(error_message, code=400, mimetype='application/json', data=None):
     payload = encode_json({'success': False, 'error': error_message, 'data':data})
     resp = make_response(payload, code)
@@ -136,10 +458,41 @@ def make_failed_response(error_message, code=400, mimetype='application/json', d
 def test_reservation(start, end, type):
     '''
         find reservations which collide with the given start and end datetime and match type
+        
+        answered from reservation_index unless it is disabled in config.reservation_index
+    '''
+    
+    if not config.reservation_index.get('enabled', True):
+        return sql_test_reservation(start, end, type)
+    
+    cursor = metrics.TimedCursor(g.cnx.cursor(buffered=True, dictionary=True), request.endpoint)
+    
+    version = table_versions.get('reservation')
+    if reservation_index.stale or not reservation_index.is_current(cursor, version):
+        log.info('[index] Loading reservations.')
+        reservation_index.load(cursor, version)
+        
+    cursor.close()
+    
+    colliding_reservations = reservation_index.colliding(start, end, type)
+    
+    if config.reservation_index.get('verify'):
+        expected = sql_test_reservation(start, end, type)
+        
+        if [row['id'] for row in expected] != [row['id'] for row in colliding_reservations]:
+            log.error('[index] Index disagrees with SQL: {} != {}'.format(
+                [row['id'] for row in colliding_reservations], [row['id'] for row in expected]))
+            return expected
+    
+    return colliding_reservations
+    
+
+def sql_test_reservation(start, end, type):
+    '''
+        test_reservation straight from the database
     '''
     
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cursor = metrics.TimedCursor(g.cnx.cursor(buffered=True, dictionary=True), request.endpoint)
     
     cursor.execute("""
                         SELECT * FROM reservation
@@ -154,14 +507,15 @@ def test_reservation(start, end, type):
                         
                         AND type = %s
                         
-                        ; """, (start, end, type))
+                        ORDER BY id
+                        
+                        ; """, (end, start, type))
     
     colliding_reservations = cursor.fetchall()
     
     log.info('Executed SQL:' + SQL_one_line(cursor.statement))
     # log.info('Colliding reservations ' + str([row['id'] for row in colliding_reservations]))
     cursor.close()
-    cnx.close()
     
     return colliding_reservations
     
@@ -181,8 +535,7 @@ def log_endpoint ():
 @app.route('/api/v1/testauth', methods=['POST'])
 def testauth():
 
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cursor = g.cursor
         
     test_user = request.get_json(force=True)
         
@@ -217,79 +570,98 @@ def testauth():
             
             
             # test password
-            if bcrypt.checkpw(test_user['password'].encode('ascii'), rows[0]['password'].encode('ascii')):
+            if auth.check_password(rows[0], test_user['password']):
                 rows[0].pop('password', None)
                 return make_success_response(rows[0])
             else:
                 return make_failed_response('incorrect password')
                 
-    finally: 
-        cursor.close()
-        cnx.close()
+
+@app.route('/api/v1/token', methods=['POST'])
+@requires_auth
+def token():
+    """ swaps basic auth credentials for a session token, which is sent
+    back as "Authorization: Bearer <token>" to skip bcrypt on later requests
+    """
+    return make_success_response(dict(token=auth.make_token(g.user),
+                                      expires_in=config.auth.get('token_max_age', 8 * 3600)))
 
 # -----------------------------------------------------------------------------
 # Users
 # -----------------------------------------------------------------------------
     
+# parts of a user for GET /api/v1/user/<id>?include=, each keyed on the user's id
+USER_INCLUDES = {
+    'loaned': """ SELECT * FROM device
+                  WHERE loaned_by = %s; """,
+    'privileges': """ SELECT type FROM device_type_privilage
+                      WHERE user_id = %s; """,
+    'classes': """ SELECT class.* FROM class, class_registration
+                   WHERE class_registration.class_id = class.id
+                   AND class_registration.user_id = %s; """
+}
+
+
+def parse_include(includes):
+    """ the names in ?include=a,b, all of includes if it isn't given """
+    if 'include' not in request.args:
+        return list(includes)
+
+    include = [name.strip() for name in request.args['include'].split(',') if name.strip()]
+
+    unknown = [name for name in include if name not in includes]
+    if unknown:
+        raise ValueError('unknown include: {}'.format(', '.join(unknown)))
+
+    return [name for name in includes if name in include]
+
+
+def fetch_with_includes(sql, includes, include, id):
+    """ the row sql finds for id, with a list under each name in include
+    from its query in includes, all in one round trip. None if not found.
+    """
+    started = time.perf_counter()
+
+    statements = [sql] + [includes[name] for name in include]
+    sets = db.fetch_sets(g.cursor, ' '.join(statements), (id,) * len(statements))
+
+    log.info('[include] {} {} fetched in {:.1f}ms'.format(
+        request.endpoint, ','.join(include) or '-', (time.perf_counter() - started) * 1000))
+
+    if not sets[0]:
+        return None
+
+    row = sets[0][0]
+    for name, rows in zip(include, sets[1:]):
+        row[name] = rows
+    return row
+
+
 @app.route('/api/v1/user/<int:id>', methods=['GET', 'DELETE'])
 def one_user(id):
-    # get a user
+    # get a user, with the parts asked for by ?include=, all by default
     if request.method == "GET":
-        cnx = mysql.connector.connect(**config.db)
-        cursor = cnx.cursor(dictionary=True)
-        
         try:
-            cursor.execute(""" SELECT id, email, fname, lname, type, created_at
-                               FROM user
-                               WHERE id = %s """, (id,))
-                               
+            include = parse_include(USER_INCLUDES)
+        except ValueError as e:
+            return make_failed_response(str(e))
+
+        try:
+            user = fetch_with_includes(""" SELECT id, email, fname, lname, type, created_at
+                                           FROM user
+                                           WHERE id = %s; """, USER_INCLUDES, include, id)
         except Exception as e:
             return make_failed_response(str(e))
-            
-        else:
-            rows = cursor.fetchall()
-            
-            if not len(rows):
-                return make_failed_response("id not found")
-                
-            else:            
-                # get their loaned devices                
-                cursor.execute(""" SELECT * FROM device
-                                   WHERE loaned_by = %s; """,
-                               (id,))
-                               
-                loaned = cursor.fetchall()
-                
-                # get their privileges
-                cursor.execute(""" SELECT type FROM device_type_privilage
-                                   WHERE user_id = %s; """,
-                               (id,))
-                               
-                privileges = cursor.fetchall()
-                               
-                # get their classes
-                cursor.execute(""" SELECT class.* FROM class, class_registration
-                                   WHERE class_registration.class_id = class.id
-                                   AND class_registration.user_id = %s; """,
-                               (id,))
-                
-            
-                classes = cursor.fetchall()
-            
-                rows[0]['loaned'] = loaned
-                rows[0]['privileges'] = privileges
-                rows[0]['classes'] = classes
-            
-                return make_success_response(rows[0])
+
+        if user is None:
+            return make_failed_response("id not found")
+
+        return make_success_response(user)
                 
-        finally:
-            cursor.close()
-            cnx.close()
 
     # delete a user
     if request.method == "DELETE":
-        cnx = mysql.connector.connect(**config.db)
-        cursor = cnx.cursor()
+        cnx, cursor = g.cnx, g.cursor
         try:
             cursor.execute(""" DELETE FROM user
                                WHERE id = %s """, (id,))
@@ -297,13 +669,14 @@ def one_user(id):
             return make_failed_response(str(e))
         else:
             cnx.commit()
+            auth.forget_user(id)
+            reservation_index.invalidate()
+            user_index.remove(id)
+            suggestions['user'].remove(id)
             if not cursor.rowcount:
                 return make_failed_response("id not found")
             else:
                 return make_success_response(dict(id=id))
-        finally:
-            cursor.close()
-            cnx.close()
 
 
 @app.route("/api/v1/user", methods=['POST', 'GET'])
@@ -311,11 +684,12 @@ def user():
     
     # add a new user
     if request.method == "POST":
-        cnx, cursor = get_database()
+        cnx, cursor = g.cnx, g.cursor
         
         new_user = request.get_json(force=True)
         
-        hashed_password = bcrypt.hashpw(new_user['password'].encode(), bcrypt.gensalt())
+        with metrics.BCRYPT_SECONDS.time('hash'):
+            hashed_password = workers.hash_pool().submit(workers.hash_password, new_user['password']).result()
         
         try:            
             cursor.execute(
@@ -343,58 +717,186 @@ def user():
             cnx.commit()
             new_id = cursor.lastrowid
             data = dict(id=new_id)
-            make_qr(new_id, QR_CODE_PATH)
+            index_new_users(cursor, new_id, new_id)
+            suggestions['user'].add(dict(new_user, id=new_id))
+            workers.submit_qr([new_id], QR_CODE_PATH)
             return make_success_response(data)
             
-        finally:
-            cursor.close()
-            cnx.close()
 
     # get all users
     if request.method == "GET":
-        cnx = mysql.connector.connect(**config.db)
-        cursor = cnx.cursor(dictionary=True)
-
-        try:
-            cursor.execute(""" SELECT id, email, fname, lname, type, created_at 
-                               FROM user """)
-        except Exception as e:
-            return make_failed_response(str(e))
-        else:
-            return make_success_response(cursor.fetchall())
-        finally:
-            cursor.close()
-            cnx.close()
+        return make_list_response(listing.users)
             
             
-@app.route('/api/v1/user/search')
-def user_search():
-
-    criteria = " OR ".join(["{} LIKE '%{}%'".format(key, request.args.get(key)) for key in request.args if request.args.get(key) not in (None, '')])
+@app.route('/api/v1/user/batch', methods=['POST'])
+def user_batch():
+    """ adds many users in one INSERT, e.g. a year group at enrolment
     
-      
-    g.cursor.execute(""" SELECT id, email, fname, lname, type, created_at 
-                         FROM user 
-                         WHERE {};""".format(criteria))
-   
-        
-    log.debug(g.cursor.statement)
-                     
-                         
-    return make_success_response(g.cursor.fetchall())
+    takes a list of users as for POST /api/v1/user, returns their ids in order.
+    Every password is hashed before the response, so a batch may hold at
+    most config.workers['user_batch_limit'] users
+    """
+    cnx, cursor = g.cnx, g.cursor
+    
+    new_users = request.get_json(force=True)
     
+    if not isinstance(new_users, list) or not len(new_users):
+        return make_failed_response("expected a list of users")
     
+    limit = config.workers.get('user_batch_limit', 100)
+    if len(new_users) > limit:
+        return make_failed_response('at most {} users per batch'.format(limit))
     
+    try:
+        with metrics.BCRYPT_SECONDS.time('hash_batch'):
+            hashed_passwords = workers.hash_passwords([u['password'] for u in new_users])
         
+        cursor.executemany(
+            """ INSERT INTO user (email, fname, lname, type, password)
+                           VALUES (%s, %s, %s, %s, %s); """,
+            [
+                (u["email"], u["fname"], u["lname"], u["type"], hashed)
+                for u, hashed in zip(new_users, hashed_passwords)
+            ]
+        )
         
+    except KeyError as e:
+        return make_failed_response('missing field {}'.format(e))
     
-    
-    
-            
+    except Exception as e:
+        cnx.rollback()
+        
+        msg = str(e)
+        if 'email_UNIQUE' in msg:
+            return make_failed_response("Sorry, one of those emails is taken!")
+        
+        return make_failed_response(msg)
+        
+    else:
+        cnx.commit()
+        # a multi-row INSERT gets consecutive ids starting at lastrowid
+        new_ids = list(range(cursor.lastrowid, cursor.lastrowid + len(new_users)))
+        index_new_users(cursor, new_ids[0], new_ids[-1])
+        for i, u in zip(new_ids, new_users):
+            suggestions['user'].add(dict(u, id=i))
+        workers.submit_qr(new_ids, QR_CODE_PATH)
+        return make_success_response([dict(id=i, email=u['email']) for i, u in zip(new_ids, new_users)])
+
+
+@app.route('/api/v1/user/search')
+def user_search():
+    """ users matching ?fname=, ?lname=, ?email= or ?id=, best first, or ?q=
+    to look in all of them. ?limit=n returns at most n.
+
+    answered from user_index, see search.UserSearch
+    """
+    terms = {key: value for key, value in request.args.items()
+             if key not in ('q', 'limit') and value != ''}
+
+    unknown = sorted(set(terms) - set(search.USER_FIELDS))
+    if unknown:
+        return make_failed_response('unknown fields: {}'.format(', '.join(unknown)))
+
+    if request.args.get('q'):
+        for field in search.USER_FIELDS:
+            terms.setdefault(field, request.args['q'])
+
+    if not terms:
+        return make_failed_response("nothing to search for")
+
+    try:
+        limit = int(request.args.get('limit', config.search.get('limit', 50)))
+    except ValueError:
+        limit = 0
+
+    if not 0 < limit <= search.MAX_LIMIT:
+        return make_failed_response('limit must be between 1 and {}'.format(search.MAX_LIMIT))
+
+    version = table_versions.get('user')
+    if user_index.stale or not user_index.is_current(version):
+        log.info('[index] Loading users.')
+        try:
+            load_user_index(version)
+        except Exception as e:
+            log.error('[index] Could not load users: {}'.format(e))
+            if user_index.loaded_at is None:
+                return make_failed_response(code=503, error_message="No database connection could be established.")
+
+    return make_success_response(user_index.search(terms, limit))
+
+
+def load_user_index(version):
+    """ (re)loads user_index on a connection of its own, as searches don't
+    take one unless the index needs loading
+    """
+    cnx, cursor = get_database()
+    try:
+        user_index.load(cursor, version)
+    finally:
+        cursor.close()
+        db.get_pool().checkin(cnx)
+
+
+def index_new_users(cursor, first_id, last_id):
+    """ adds users this process just inserted to user_index """
+    if user_index.loaded_at is None:
+        return  # they'll be read with the rest on first search
+
+    cursor.execute(""" SELECT id, email, fname, lname, type, created_at
+                       FROM user
+                       WHERE id BETWEEN %s AND %s; """, (first_id, last_id))
+
+    user_index.add(cursor.fetchall())
+
+
             
+@app.route('/api/v1/suggest')
+def suggest():
+    """ typeahead for lookup boxes, ?q=<start of a name, email, serial
+    number or id>&kind=user|device, answered from memory
+    """
+    kind = request.args.get('kind', 'user')
+    if kind not in suggestions:
+        return make_failed_response("kind must be one of: " + ', '.join(sorted(suggestions)))
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return make_success_response([])
+
+    index = suggestions[kind]
+    if index.stale:
+        try:
+            load_suggestions(index)
+        except Exception as e:
+            log.error('[suggest] Could not load {}s: {}'.format(kind, e))
+            if index.loaded_at is None:
+                return make_failed_response(code=503, error_message="No database connection could be established.")
+
+    return make_success_response(index.suggest(q, config.search.get('suggest_limit', 10)))
+
+
+def load_suggestions(index):
+    cnx, cursor = get_database()
+    try:
+        index.load(cursor)
+    finally:
+        cursor.close()
+        db.get_pool().checkin(cnx)
+    log.info('[suggest] Loaded {}s.'.format(index.table))
+
+
+def warm_suggestions():
+    """ builds the typeahead indexes at startup, not on the first keystroke """
+    for kind, index in suggestions.items():
+        try:
+            load_suggestions(index)
+        except Exception as e:
+            log.error('[suggest] Could not load {}s: {}'.format(kind, e))
+
+
 @app.route('/api/v1/user/<int:user_id>/privilege/<type>', methods=['PUT', 'DELETE'])
 def user_privilege (user_id, type):
-    cnx, cursor = get_database()
+    cnx, cursor = g.cnx, g.cursor
 
     if request.method == 'PUT':
         try:
@@ -409,9 +911,6 @@ def user_privilege (user_id, type):
         else:
             cnx.commit()
             return make_success_response(dict(id=cursor.lastrowid))
-        finally:
-            cursor.close()
-            cnx.close()
             
     if request.method == 'DELETE':
         try:
@@ -427,9 +926,6 @@ def user_privilege (user_id, type):
             else:
                 log.info('Removed privilege {} for {}'.format(type, user_id))
                 return make_success_response(dict(user_id=user_id, type=type))
-        finally:
-            cursor.close()
-            cnx.close()
             
 # -----------------------------------------------------------------------------
 # Cards
@@ -437,58 +933,173 @@ def user_privilege (user_id, type):
   
 @app.route('/api/v1/user/card/<user_selection>')
 def user_card(user_selection):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    try:
+        ids = parse_range(user_selection)
+    except ValueError as e:
+        return make_failed_response(str(e))
 
-    ids = parse_range(user_selection)
+    # the template reads the rows as it is sent, after teardown_request
+    cursor = g.cursor
+    release = release_database()
+    
+    response = stream_template('cards.html', users=card_rows('user', ids, cursor))
+    response.call_on_close(release)
+    return response
+    
 
-    sql_where = ', '.join(str(i) for i in ids)
+@app.route('/api/v1/user/card/<user_selection>/pdf')
+def user_card_pdf(user_selection):
+    try:
+        ids = parse_range(user_selection)
+    except ValueError as e:
+        return make_failed_response(str(e))
 
-    cursor.execute(""" SELECT id, email, fname, lname, type, created_at FROM user
-                       WHERE id IN ({});""".format(sql_where))  # yes, this is safe
+    rows = list(card_rows('user', ids))
+    return send_file(render_cards('user', rows), mimetype='application/pdf')
 
-    data = cursor.fetchall()
 
-    cursor.close()
-    cnx.close()
+# kind -> (template, name of the rows in it, query)
+CARDS = {
+    'user': ('cards.html', 'users',
+             """ SELECT id, email, fname, lname, type, created_at FROM user WHERE {} ORDER BY id; """),
+    'device': ('devices.html', 'devices',
+               """ SELECT id, type, serial_no, type FROM device WHERE {} ORDER BY id; """)
+}
+
+# ids fetched per query for a card selection
+SELECTION_CHUNK_SIZE = 1000
 
-    return render_template('cards.html', users=data)
+
+def card_rows(kind, ids, cursor=None):
+    """ yields the rows for a Selection of ids, a chunk of ids per query,
+    read with cursor or g.cursor
+    """
+    if cursor is None:
+        cursor = g.cursor
     
+    for chunk in ids.chunks(SELECTION_CHUNK_SIZE):
+        sql_where, params = chunk.where('id')
+        cursor.execute(CARDS[kind][2].format(sql_where), params)
+        yield from cursor.fetchall()
 
-@app.route('/api/v1/user/card/<user_selection>/pdf')
-def user_card_pdf(user_selection):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
 
-    ids = parse_range(user_selection)
+def stream_template(template, **context):
+    """ a response rendering template as it goes, so iterables in context
+    are only read as the template reaches them
+    """
+    app.update_template_context(context)
+    body = app.jinja_env.get_template(template).generate(context)
+    return Response(stream_with_context(body))
 
-    sql_where = ', '.join(str(i) for i in ids)
 
-    cursor.execute(""" SELECT id, email, fname, lname, type, created_at FROM user
-                       WHERE id IN ({});""".format(sql_where))  # yes, this is safe
+def render_cards(kind, rows, progress=None):
+    """ the filename of a PDF of cards for rows, see cards.CardRenderer """
+    template, name, _ = CARDS[kind]
 
-    data = cursor.fetchall()
+    def html(chunk):
+        # its own context, as big jobs render outside any request
+        with app.test_request_context():
+            return render_template(template, **{name: chunk})
 
-    cursor.close()
-    cnx.close()
+    return card_renderer.render(template, html, rows, config.pdf['cards_per_page'][template], progress)
 
-    # Make a PDF straight from HTML in a string.
-    html = render_template('cards.html', users=data)
-    return render_pdf(HTML(string=html))
+
+@app.route('/api/v1/cards/jobs', methods=['POST'])
+def card_job():
+    """ starts rendering cards to PDF in the background, for
+    {"kind": "user" or "device", "selection": "1-2000"}
+
+    poll GET /api/v1/cards/jobs/<id>, then fetch the PDF from
+    /api/v1/cards/jobs/<id>/download
+    """
+    body = request.get_json(force=True)
+
+    if not isinstance(body, dict):
+        return make_failed_response("expected an object with a kind and a selection")
+
+    if body.get('kind') not in CARDS:
+        return make_failed_response("kind must be one of: " + ', '.join(sorted(CARDS)))
+
+    try:
+        ids = parse_range(str(body['selection']))
+    except KeyError:
+        return make_failed_response("a selection is required")
+    except ValueError as e:
+        return make_failed_response(str(e))
+
+    rows = list(card_rows(body['kind'], ids))
+
+    job = job_registry.add(jobs.Job('cards', len(rows)))
+    job_registry.run(job, jobs.card_pdf, partial(render_cards, body['kind']), rows,
+                     os.path.join(SPOOL_PATH, job.id + '.pdf'))
+
+    return make_success_response(job.to_dict(), code=202)
     
       
-@app.route('/api/v1/user/generate_qr/<user_selection>')
-def generate_qr(user_selection):
+@app.route('/static/img/qr/<int:qr_id>.png')
+def qr_code(qr_id):
+    """ serves QR code images for cards, drawing any that don't exist yet """
+    etag = qr_store.etag(qr_id)
+    
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(qr_store.get(qr_id), mimetype='image/png')
+    
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = config.qr.get('max_age', 7 * 24 * 3600)
+    return resp
 
-    ids = parse_range(user_selection)
 
+@app.route('/api/v1/user/generate_qr/<user_selection>')
+def generate_qr(user_selection):
+    """ starts a job drawing QR codes for a selection, e.g. 1-2000
+    
+    ?output=zip puts them all in one zip file instead of static/img/qr,
+    ?overwrite=1 redraws images which already exist
+    
+    poll GET /api/v1/jobs/<id> for progress and failures
+    """
     try:
-        for i in ids:
-            make_qr(i, QR_CODE_PATH)
-    except Exception as e:
+        ids = parse_range(user_selection)
+    except ValueError as e:
         return make_failed_response(str(e))
+    
+    job = job_registry.add(jobs.Job('qr', len(ids)))
+    
+    if request.args.get('output') == 'zip':
+        job_registry.run(job, jobs.qr_zip, ids, os.path.join(SPOOL_PATH, job.id + '.zip'))
     else:
-        return make_success_response(ids)
+        job_registry.run(job, jobs.qr_files, ids, QR_CODE_PATH, request.args.get('overwrite') == '1')
+    
+    return make_success_response(job.to_dict(), code=202)
+
+
+# -----------------------------------------------------------------------------
+# Jobs
+# -----------------------------------------------------------------------------
+
+@app.route('/api/v1/jobs/<job_id>')
+@app.route('/api/v1/cards/jobs/<job_id>')
+def job_status(job_id):
+    job = job_registry.get(job_id)
+    
+    if job is None:
+        return make_failed_response("job not found", code=404)
+    
+    return make_success_response(job.to_dict())
+
+
+@app.route('/api/v1/jobs/<job_id>/download')
+@app.route('/api/v1/cards/jobs/<job_id>/download')
+def job_download(job_id):
+    job = job_registry.get(job_id)
+    
+    if job is None or job.result is None:
+        return make_failed_response("job not found or has nothing to download", code=404)
+    
+    return send_file(job.result, as_attachment=True, conditional=True)
         
         
 # -----------------------------------------------------------------------------
@@ -497,28 +1108,14 @@ def generate_qr(user_selection):
 
 @app.route('/api/v1/device', methods=['POST', 'GET'])
 def device ():
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
     if request.method == 'GET':
-        try:
-            cursor.execute(""" SELECT * FROM device; """)
-        except Exception as e:
-            return make_failed_response(str(e))
-        else:        
-            data = cursor.fetchall()
-            for row in data:
-                row['is_active'] = True if row['is_active'] else False            
-            return make_success_response(data)
-        finally:
-            cursor.close()
-            cnx.close()
+        return make_list_response(listing.devices)
     
     # add a new device
     if request.method == "POST":
 
-        cnx, cursor = get_database()
-        
         new_device = request.get_json(force=True)
         
         try:
@@ -538,20 +1135,17 @@ def device ():
         else:
             cnx.commit()
             new_id = cursor.lastrowid
-            make_qr(new_id, QR_CODE_PATH)
+            suggestions['device'].add(dict(new_device, id=new_id))
+            workers.submit_qr([new_id], QR_CODE_PATH)
             data = dict(id=new_id)
             return make_success_response(data)
-        finally:
-            cursor.close()
-            cnx.close()
 
 
 @app.route('/api/v1/device/<int:id>', methods=['GET', 'DELETE'])
 def one_device(id):
     # get a device
     if request.method == "GET":
-        cnx = mysql.connector.connect(**config.db)
-        cursor = cnx.cursor(dictionary=True)
+        cnx, cursor = g.cnx, g.cursor
         try:
             cursor.execute(""" SELECT * FROM device
                                WHERE id = %s """, (id,))
@@ -563,14 +1157,10 @@ def one_device(id):
                 return make_failed_response("id not found")
             else:
                 return make_success_response(rows[0])
-        finally:
-            cursor.close()
-            cnx.close()
 
     # delete a device
     if request.method == "DELETE":
-        cnx = mysql.connector.connect(**config.db)
-        cursor = cnx.cursor()
+        cnx, cursor = g.cnx, g.cursor
         try:
             cursor.execute(""" DELETE FROM device
                                WHERE id = %s """, (id,))
@@ -578,19 +1168,17 @@ def one_device(id):
             return make_failed_response(str(e))
         else:
             cnx.commit()
+            suggestions['device'].remove(id)
             if not cursor.rowcount:
                 return make_failed_response("id not found")
             else:
                 return make_success_response(dict(id=id))
-        finally:
-            cursor.close()
-            cnx.close()
 
 
 @app.route('/api/v1/device/<int:id>/active', methods=['PUT', 'DELETE'])
 def device_active (id):
 
-    cnx, cursor = get_database()
+    cnx, cursor = g.cnx, g.cursor
 
     is_active = True 
     
@@ -602,156 +1190,142 @@ def device_active (id):
             
         
     cnx.commit()
-    cursor.close()
-    cnx.close()    
     
+    if cursor.rowcount:
+        event_bus.publish('device_active', dict(id=id, is_active=is_active))
         
     return ('', 200)
 
  
 @app.route('/api/v1/device/<int:device_id>/loan/<int:user_id>', methods=['PUT', 'DELETE'])
 def loan (device_id, user_id):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
     # attempt to loan
-    if request.method == 'PUT':        
-        # is user privileged for this device?        
-        cursor.execute(""" SELECT COUNT(device_type_privilage.type) AS count
-                           FROM device, device_type_privilage
-                           WHERE device.type = device_type_privilage.type
-                           AND device_type_privilage.user_id = %s
-                           AND device.type = (SELECT type FROM device WHERE id = %s);""",
-                           (user_id,device_id))
-        
-        row = cursor.fetchone()
-        
-        count = row['count']
-        
-        log.info('[check] [privilege] Executed SQL: ' + SQL_one_line(cursor.statement))
+    if request.method == 'PUT':
+        started = time.perf_counter()
         
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
         
+        engine = loans.LoanEngine(cursor, now, lambda type: test_reservation(now, now, type))
+        engine.prepare([device_id], [user_id])
         
+        failure = engine.check(device_id, user_id)
         
-        if count == 0:
-            log.info('[check] [privilege] User {} not privileged to loan device {}'.format(user_id, device_id))
-            return make_failed_response(error_message = 1)
+        if failure is None:
+            log.info('[check] [safety] All checks passed.')
+            engine.lend([(device_id, user_id)])
+            cnx.commit()
+            event_bus.publish('loan', dict(device_id=device_id, user_id=user_id))
+        else:
+            cnx.rollback()
         
+        log.info('[check] Loan of {} to {} decided in {:.1f}ms'.format(
+            device_id, user_id, (time.perf_counter() - started) * 1000))
         
-        # is the device loaned by a user?
-        cursor.execute(""" SELECT COUNT(id) AS count, loaned_by, type
-                           FROM device WHERE id = %s
-                           AND loaned_by IS NOT NULL """, (device_id,))        
-        device = cursor.fetchone()        
-        if device['count']:
-            log.info('[check] [loan] Device {} already loaned.'.format(device_id))
-            cursor.execute(""" SELECT user.id, user.email, user.fname, 
-                               user.lname, user.type, user.created_at
-                               FROM user
-                               WHERE user.id = %s; """, (device['loaned_by'],))                               
-            user = cursor.fetchone()            
-            return make_failed_response(error_message = 2, data = user)
-            
+        if failure is not None:
+            error_message, data = failure
+            return make_failed_response(error_message=error_message, data=data)
         
-        else:            
-            # we now check safety
-            
-            now = datetime.utcnow().replace(tzinfo=timezone.utc)
-            
-            cursor.execute("""SELECT type FROM device WHERE id = %s""", (device_id,))
-            
-            device_type = cursor.fetchone()['type']
-            
-            log.info('[check] [safety] Device type: {}'.format(device_type))           
-            
-            colliding_reservations = test_reservation(now, now, device_type)
-            
-            log.info('[check] [safety] Colliding reservations: {}'.format(colliding_reservations))
-            
-            cursor.execute(""" SELECT COUNT(*) AS count FROM device WHERE type = %s AND is_active = 1""", (device_type,))
-            
-            total_devices = cursor.fetchone()['count']
-            
-            total_reserved = sum([int(row['count']) for row in colliding_reservations])
-            
-            log.info('[check] [safety] total_reserved: ' + str(total_reserved))
-            
-            log.info('[check] [safety] Total active devices ({}): {}'.format(device_type, total_devices))
-            
-            remaining = total_devices - total_reserved - 1
-            
-            log.info ('[check] [safety] Active devices which will be left: ' + str(remaining))
-            
-            if remaining < 0:
-                if len(colliding_reservations) == 0: # there are plainly no active unloaned devices left,
-                                                     # even if there are no reservations
-                                                     # ideally, this should never happen as an inactive 
-                                                     # and unloaned device wouldn't normally be requested
-                                                     
-                    log.info ('[check] [safety] Failed, remaining = {}'.format(remaining))                          
-                    return make_failed_response(error_message=3)
-            
-                # now only allow if student is in one of the classes of any of the colliding reservations
-                cursor.execute(""" SELECT class_id FROM class_registration WHERE user_id = %s """, (user_id,))
-            
-                user_classes = set([row['class_id'] for row in cursor.fetchall()])
-                reservation_classes = set([row['class_id'] for row in colliding_reservations])
-                common_classes = user_classes.intersection(reservation_classes)
-            
-                log.info('[check] [safety] user classes: {}'.format(user_classes))
-                log.info('[check] [safety] reservation classes: {}'.format(reservation_classes))
-                log.info('[check] [safety] no. of common classes: {}'.format(len(common_classes)))
-                
-                if len(common_classes) == 0:
-                    log.info('[check] [safety] Failed. common classes = 0')
-                    return make_failed_response(error_message=3, data = colliding_reservations)
-                               
-            
-            log.info('[check] [safety] All checks passed.')
-            cursor.execute(""" UPDATE device SET loaned_by = %s
-                               WHERE device.id = %s """, (user_id, device_id))
-            cnx.commit()
-            cursor.close()
-            cnx.close()
-            
-            return make_success_response (data=dict(device_id=device_id, user_id=user_id))
-            
-            
+        return make_success_response (data=dict(device_id=device_id, user_id=user_id))
         
     # attempt to return device
     if request.method == 'DELETE':
         
-        # check same user returning, device  exists, or is loaned
-        cursor.execute(""" SELECT COUNT(id) AS count
-                           FROM device WHERE id = %s
-                           AND loaned_by = %s """, (device_id, user_id))
-                           
-        count = cursor.fetchone()['count']
-        
-        if count == 0:
-            return make_failed_response (error_message='invalid user/device')
-
+        # only the same user can return it, if it exists and is loaned
         cursor.execute(""" UPDATE device 
                            SET loaned_by = NULL
-                           WHERE device.id = %s; """, (device_id,))
+                           WHERE device.id = %s
+                           AND loaned_by = %s; """, (device_id, user_id))
+        
+        if cursor.rowcount == 0:
+            cnx.rollback()
+            return make_failed_response (error_message='invalid user/device')
                            
         cnx.commit()
-        cursor.close()
-        cnx.close()
+        event_bus.publish('return', dict(device_id=device_id, user_id=user_id))
 
         return make_success_response (data=dict(device_id=device_id, user_id=user_id))
 
 
+def loan_pairs(items):
+    """ (device_id, user_id) pairs from a batch request body, which is a list
+    of {"device_id": .., "user_id": ..} objects or [device_id, user_id] pairs
+    """
+    if not isinstance(items, list) or not len(items):
+        raise ValueError('expected a list of device and user ids')
+    
+    if len(items) > loans.MAX_BATCH:
+        raise ValueError('at most {} items per batch'.format(loans.MAX_BATCH))
+    
+    pairs = []
+    for item in items:
+        if isinstance(item, dict):
+            item = (item.get('device_id'), item.get('user_id'))
+        device_id, user_id = item
+        pairs.append((int(device_id), int(user_id)))
+        
+    return pairs
+
+
+@app.route('/api/v1/loan/batch', methods=['POST', 'DELETE'])
+def loan_batch ():
+    """ loans (POST) or returns (DELETE) a cart of devices in one transaction
+    
+    every item gets a result like the single loan endpoint's response
+    """
+    cnx, cursor = g.cnx, g.cursor
+    
+    try:
+        pairs = loan_pairs(request.get_json(force=True))
+    except (TypeError, ValueError) as e:
+        return make_failed_response(str(e))
+    
+    now = datetime.utcnow().replace(tzinfo=timezone.utc)
+    
+    engine = loans.LoanEngine(cursor, now, lambda type: test_reservation(now, now, type))
+    
+    results = []
+    
+    # attempt to loan
+    if request.method == 'POST':
+        engine.prepare([d for d, _ in pairs], [u for _, u in pairs])
+        
+        failures = engine.check_many(pairs)
+        
+        engine.lend([pair for pair, failure in zip(pairs, failures) if failure is None])
+        
+        for (device_id, user_id), failure in zip(pairs, failures):
+            error, data = failure or (None, None)
+            results.append(dict(device_id=device_id, user_id=user_id,
+                                success=failure is None, error=error, data=data))
+    
+    # attempt to return devices
+    if request.method == 'DELETE':
+        engine.lock_devices([d for d, _ in pairs])
+        
+        for (device_id, user_id), ok in zip(pairs, engine.give_back(pairs)):
+            results.append(dict(device_id=device_id, user_id=user_id, success=ok,
+                                error=None if ok else 'invalid user/device', data=None))
+    
+    cnx.commit()
+    
+    kind = 'loan' if request.method == 'POST' else 'return'
+    event_bus.publish_many([(kind, dict(device_id=result['device_id'], user_id=result['user_id']))
+                            for result in results if result['success']])
+    
+    log.info('[batch] {} of {} items succeeded'.format(sum(r['success'] for r in results), len(results)))
+    
+    return make_success_response(results)
+
+
 @app.route('/api/v1/device/type', methods=['GET'])        
 def device_type ():
-    cnx, cursor = get_database()
+    cursor = g.cursor
     
     cursor.execute(""" SELECT DISTINCT type FROM device; """)
     
-    types = [row.type for row in cursor.fetchall()]
-    
-    cursor.close()
-    cnx.close()
+    types = [row['type'] for row in cursor.fetchall()]
     
     log.info(str(types))
     
@@ -759,24 +1333,13 @@ def device_type ():
 
 @app.route('/api/v1/device/card/<device_selection>/pdf')
 def device_cards(device_selection):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
-
-    ids = parse_range(device_selection)
-
-    sql_where = ', '.join(str(i) for i in ids)
-
-    cursor.execute(""" SELECT id, type, serial_no, type FROM device
-                       WHERE id IN ({});""".format(sql_where))
-
-    data = cursor.fetchall()
-
-    cursor.close()
-    cnx.close()
+    try:
+        ids = parse_range(device_selection)
+    except ValueError as e:
+        return make_failed_response(str(e))
 
-    # Make a PDF straight from HTML in a string.
-    html = render_template('devices.html', devices=data)
-    return render_pdf(HTML(string=html))
+    rows = list(card_rows('device', ids))
+    return send_file(render_cards('device', rows), mimetype='application/pdf')
     
 # -----------------------------------------------------------------------------
 # Reservation
@@ -784,25 +1347,12 @@ def device_cards(device_selection):
 
 @app.route('/api/v1/reservation', methods=['GET', 'POST'])
 def reservation ():
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
     # get all reservations
     if request.method == 'GET':
-        try:
-            cursor.execute(""" SELECT * FROM reservation; """)
-            
-        except Exception as e:
-            return make_failed_response(str(e))
+        return make_list_response(listing.reservations)
             
-        else:        
-            reservations = cursor.fetchall()
-            dict_dates_to_utc(reservations)            
-            return make_success_response(reservations)
-            
-        finally:
-            cursor.close()
-            cnx.close()
         
     # add reservation
     if request.method == 'POST':
@@ -818,7 +1368,8 @@ def reservation ():
         
         total_devices = cursor.fetchone()['count']
         
-        total_reserved = sum([int(row['count']) for row in colliding_reservations])
+        # the most reserved at once, rather than every overlap added together
+        total_reserved = reservations.peak_reserved(colliding_reservations, start_time, end_time)
         
         log.info('Total reserved: {}'.format(total_reserved))
         
@@ -863,16 +1414,61 @@ def reservation ():
         
             cnx.commit()
             new_id = cursor.lastrowid
+            
+            cursor.execute(""" SELECT * FROM reservation WHERE id = %s """, (new_id,))
+            row = cursor.fetchone()
+            reservation_index.add(row)
+            
+            row = dict(row)
+            dict_dates_to_utc([row])
+            event_bus.publish('reservation_created', row)
+            
             data = dict(id=new_id)
             return make_success_response(data)
-        finally:
-            cursor.close()
-            cnx.close()
+
+@app.route('/api/v1/reservation/availability')
+def reservation_availability():
+    """ free devices of a type over time, e.g.
+    
+    /api/v1/reservation/availability?type=ipad&start=2016-09-01T09:00Z&end=2016-09-01T15:00Z
+    """
+    cursor = g.cursor
+    
+    try:
+        type = request.args['type']
+        start_time = date_parse(request.args['start']).astimezone(tz=timezone.utc)
+        end_time = date_parse(request.args['end']).astimezone(tz=timezone.utc)
+    except (KeyError, ValueError) as e:
+        return make_failed_response('type, start and end are required: ' + str(e))
+    
+    if end_time < start_time:
+        return make_failed_response('end is before start')
+    
+    colliding_reservations = test_reservation(start_time, end_time, type)
+    
+    cursor.execute(""" SELECT COUNT(*) AS count FROM device WHERE type = %s AND is_active = 1""", (type,))
+    
+    total_devices = cursor.fetchone()['count']
+    
+    segments, peak = reservations.timeline(colliding_reservations, start_time, end_time)
+    
+    return make_success_response(dict(
+        type=type,
+        start_time=start_time,
+        end_time=end_time,
+        total=total_devices,
+        reserved=peak,
+        free=total_devices - peak,
+        timeline=[dict(start_time=a.replace(tzinfo=timezone.utc),
+                       end_time=b.replace(tzinfo=timezone.utc),
+                       reserved=reserved,
+                       free=total_devices - reserved)
+                  for a, b, reserved in segments]))
+
 
 @app.route('/api/v1/reservation/<int:id>', methods=['DELETE', 'GET'])
 def one_reservation(id):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
 
     # delete (revoke) a reservation
     if request.method == 'DELETE':
@@ -885,14 +1481,13 @@ def one_reservation(id):
             
         else:
             cnx.commit()
+            reservation_index.remove(id)
             if not cursor.rowcount:
                 return make_failed_response("id not found")
             else:
+                event_bus.publish('reservation_deleted', dict(id=id))
                 return make_success_response(dict(id=id))
                 
-        finally:
-            cursor.close()
-            cnx.close()
         
     if request.method == 'GET':
         try:
@@ -911,9 +1506,6 @@ def one_reservation(id):
                 dict_dates_to_utc(rows)
                 return make_success_response(rows[0])
                 
-        finally:
-            cursor.close()
-            cnx.close()
 
 # -----------------------------------------------------------------------------
 # Classes (Academic)
@@ -921,30 +1513,16 @@ def one_reservation(id):
     
 @app.route('/api/v1/class', methods=['GET', 'POST'])
 def all_class ():
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
     # get all classes
     if request.method == 'GET':
-        try:
-            cursor.execute(""" SELECT * FROM class; """)
-            
-        except Exception as e:
-            return make_failed_response(str(e))
+        return make_list_response(listing.classes)
             
-        else:        
-            data = cursor.fetchall()           
-            return make_success_response(data)
-            
-        finally:
-            cursor.close()
-            cnx.close()
     
     # add a new class
     if request.method == "POST":
 
-        cnx, cursor = get_database()
-        
         new_class = request.get_json(force=True)
         
         try:
@@ -967,54 +1545,43 @@ def all_class ():
             data = dict(id=new_id)
             return make_success_response(data)
             
-        finally:
-            cursor.close()
-            cnx.close()
             
             
+# parts of a class for GET /api/v1/class/<id>?include=
+CLASS_INCLUDES = {
+    'users': """ SELECT user.id, user.email, user.fname,
+                 user.lname, user.type, user.created_at
+                 FROM class_registration, user
+                 WHERE class_registration.class_id = %s
+                 AND class_registration.user_id = user.id; """
+}
+
+
 @app.route('/api/v1/class/<int:id>', methods=['GET', 'DELETE'])
 def one_class (id):
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
-    # get a class
+    # get a class, with its users unless ?include= leaves them out
     if request.method == "GET":
         try:
-            cursor.execute(""" SELECT * FROM class
-                               WHERE `class`.`id` = %s """, (id,))
-                               
-            classes = cursor.fetchall()
-                               
-            
+            include = parse_include(CLASS_INCLUDES)
+        except ValueError as e:
+            return make_failed_response(str(e))
+
+        try:
+            found = fetch_with_includes(""" SELECT * FROM class
+                                            WHERE `class`.`id` = %s; """, CLASS_INCLUDES, include, id)
         except Exception as e:
             return make_failed_response(str(e))
-        else:
-            if not len(classes):
-                return make_failed_response("id not found")
-            else:
-                # now we get who is registered for this class                
-                cursor.execute(""" SELECT user.id, user.email, user.fname, 
-                                   user.lname, user.type, user.created_at
-                                   FROM class_registration, user
-                                   WHERE class_registration.class_id = %s 
-                                   AND class_registration.user_id = user.id;""", (id,))
-                
-                users = cursor.fetchall()                
-                
-                classes[0]['users'] = users
-                
-                log.info (str(classes))
-            
-                return make_success_response(classes[0])
-        finally:
-            cursor.close()
-            cnx.close()
+
+        if found is None:
+            return make_failed_response("id not found")
+
+        return make_success_response(found)
     
     # remove a class
     if request.method == "DELETE":
         
-        cnx, cursor = get_database()
-        
         try:
             cursor.execute(""" DELETE FROM class
                                WHERE id = %s """, (id,))
@@ -1028,15 +1595,14 @@ def one_class (id):
                 return make_failed_response("id not found")
             else:
                 log.info('Deleted class {}.'.format(id))
+                # its reservations may have gone with it
+                reservation_index.invalidate()
                 return make_success_response(dict(id=id))
-        finally:
-            cursor.close()
-            cnx.close()
 
 
 @app.route('/api/v1/class/<int:class_id>/user/<int:user_id>', methods=['PUT', 'DELETE'])
 def class_register (class_id, user_id):
-    cnx, cursor = get_database()
+    cnx, cursor = g.cnx, g.cursor
 
     # register user
     if request.method == 'PUT':
@@ -1048,9 +1614,6 @@ def class_register (class_id, user_id):
         else:
             cnx.commit()
             return make_success_response(dict(id=cursor.lastrowid))
-        finally:
-            cursor.close()
-            cnx.close()
 
     # deregister user
     if request.method == 'DELETE':
@@ -1066,15 +1629,11 @@ def class_register (class_id, user_id):
                 return make_failed_response("ids not found")
             else:
                 return make_success_response(dict(class_id=class_id, user_id=user_id))
-        finally:
-            cursor.close()
-            cnx.close()
             
     
 @app.route('/api/v1/lateness', methods=['GET', 'POST'])
 def lateness():
-    cnx = mysql.connector.connect(**config.db)
-    cursor = cnx.cursor(dictionary=True)
+    cnx, cursor = g.cnx, g.cursor
     
     if request.method == 'POST':
         new_lateness = request.get_json(force=True)
@@ -1102,27 +1661,54 @@ def lateness():
         else:
             cnx.commit()
             new_id = cursor.lastrowid
+            event_bus.publish('lateness', dict(id=new_id, user_id=new_lateness['user_id'], datetime=d))
             data = dict(id=new_id)
             return make_success_response(data)
             
-        finally:
-            cursor.close()
-            cnx.close()
             
             
     if request.method == 'GET':
-        
-        cursor.execute (""" SELECT * FROM lateness; """)
-        
-        rows = cursor.fetchall()
-        
-        dict_dates_to_utc(rows)
+        return make_list_response(listing.lateness)
 
-        cursor.close()
-        cnx.close()
         
-        return make_success_response(data = rows)
-
+# -----------------------------------------------------------------------------
+# Events
+# -----------------------------------------------------------------------------
+@app.route('/api/v1/events')
+def events_feed():
+    """ a server-sent events stream of changes, instead of polling:
+    
+    loan, return           {"device_id": .., "user_id": ..}
+    device_active          {"id": .., "is_active": ..}
+    reservation_created    the reservation
+    reservation_deleted    {"id": ..}
+    lateness               {"id": .., "user_id": .., "datetime": ..}
+    reset                  events were missed, read everything again
+    
+    reconnecting with Last-Event-ID (or ?last_event_id=) sends what was
+    missed. A client that falls behind is disconnected and should reconnect.
+    Events made through every server process are sent, see events.EventLog.
+    Here each open stream holds a thread; asgi.py serves this same feed on
+    its event loop instead.
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    keepalive = config.events.get('keepalive', 15)
+    
+    client = event_bus.subscribe(last_id)
+    
+    def stream():
+        try:
+            yield 'retry: {}\n\n'.format(config.events.get('retry', 3000))
+            for event in client.events(keepalive):
+                yield events.format_event(event)
+        finally:
+            event_bus.unsubscribe(client)
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # stop nginx holding events back
+    return response
+    
         
 # -----------------------------------------------------------------------------
 # Config
@@ -1130,8 +1716,41 @@ def lateness():
 @app.route('/api/v1/config')
 def app_config():
     return jsonify (config.app)
+
+
+@app.route('/api/v1/metrics')
+def metrics_endpoint():
+    """ request, SQL, pool, bcrypt, QR and PDF timings in the Prometheus
+    text format. Each server process counts its own, so with several
+    workers a scrape sees whichever one answers it.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
       
       
+_started = False
+_start_lock = threading.Lock()
+
+
+def start():
+    """ starts this server process's background work: answering UDP
+    discovery and warming the typeahead indexes. Returns the app, so
+    gunicorn can be pointed at 'app:start()'.
+
+    Importing this module starts nothing, as the spawned processes of
+    workers.py import it again as __mp_main__ when run as python app.py.
+    """
+    global _started
+
+    with _start_lock:
+        if not _started:
+            _started = True
+            udp.go()
+            threading.Thread(name='suggestions', target=warm_suggestions, daemon=True).start()
+
+    return app
+
+
 if __name__ == "__main__":
     DEBUG = True
+    start()
     app.run(debug=DEBUG, host='0.0.0.0', port=53455)
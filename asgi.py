@@ -0,0 +1,228 @@
+""" The API as an ASGI app, e.g.
+
+    uvicorn asgi:application --workers 4
+
+The list endpoints, which only wait on MySQL, are answered on the event
+loop from an aiomysql pool, so a slow query holds no thread, and so is
+/api/v1/events, so an open feed holds none either. Everything else goes
+to the Flask app in app.py through a2wsgi's thread pool, where bcrypt
+and PDF rendering still run in the process pools of workers.py.
+
+Responses are the same as from app.py, down to the ETags.
+
+Needs aiomysql, a2wsgi and an ASGI server such as uvicorn.
+"""
+import asyncio
+import time
+from urllib.parse import parse_qsl
+
+import aiomysql
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+import app as flask_app
+import config
+import events
+import listing
+import metrics
+from log import log
+from util import Envelope, encode_json
+
+# GET paths answered here, with their endpoint in app.py and query
+LISTS = {
+    '/api/v1/user': ('user', listing.users),
+    '/api/v1/device': ('device', listing.devices),
+    '/api/v1/reservation': ('reservation', listing.reservations),
+    '/api/v1/class': ('all_class', listing.classes),
+    '/api/v1/lateness': ('lateness', listing.lateness)
+}
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+event_bus = events.AsyncEventBus(flask_app.event_log, queue_size=config.events.get('queue_size', 100),
+                                 poll=config.events.get('poll', 0.25))
+
+
+async def get_pool():
+    """ this process's aiomysql pool, sized like db.get_pool() """
+    global _pool
+
+    async with _pool_lock:
+        if _pool is None:
+            c = config.db
+            _pool = await aiomysql.create_pool(
+                host=c.get('host', 'localhost'), port=c.get('port', 3306),
+                user=c['user'], password=c.get('password', ''), db=c['database'],
+                init_command="SET time_zone = '{}'".format(c.get('time_zone', '+00:00')),
+                minsize=1, maxsize=c.get('pool_size', 5) + c.get('pool_max_overflow', 10),
+                autocommit=True)
+    return _pool
+
+
+class Reply:
+    """ sends one HTTP response over ASGI """
+
+    def __init__(self, send):
+        self.send = send
+        self.status = None
+
+    async def start(self, status, headers=(), mimetype='application/json'):
+        self.status = status
+        headers = [(b'content-type', mimetype.encode()),
+                   (b'access-control-allow-origin', b'*')] + list(headers)
+        await self.send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+    async def body(self, text, more=True):
+        await self.send({'type': 'http.response.body', 'body': text.encode(), 'more_body': more})
+
+    async def failed(self, error_message, code=400):
+        await self.start(code)
+        await self.body(encode_json({'success': False, 'error': error_message, 'data': None}), more=False)
+
+
+async def list_endpoint(scope, reply, endpoint, query):
+    """ app.make_list_response, awaiting the database """
+
+    query_string = scope['query_string'].decode('latin-1')
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+
+    args = {}
+    for key, value in parse_qsl(query_string, keep_blank_values=True):
+        args.setdefault(key, value)
+
+    # as app.before_request, before the database is read
+    tables = flask_app.READS[endpoint]
+    etag, last_modified = flask_app.validators(endpoint, scope['path'] + '?' + query_string,
+                                               flask_app.table_versions.get(*tables),
+                                               flask_app.table_versions.changed_at(*tables))
+
+    validation = [(b'etag', quote_etag(etag).encode()), (b'cache-control', b'no-cache')]
+    if last_modified is not None:
+        validation.append((b'last-modified', http_date(last_modified).encode()))
+
+    environ = {'REQUEST_METHOD': 'GET'}
+    for header in ('if-none-match', 'if-modified-since'):
+        if header in headers:
+            environ['HTTP_' + header.upper().replace('-', '_')] = headers[header]
+
+    if not is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        await reply.start(304, validation)
+        await reply.body('', more=False)
+        return
+
+    columnar = args.get('format', 'json') == 'columnar'
+
+    if args.get('format', 'json') not in ('json', 'columnar'):
+        return await reply.failed('format must be json or columnar')
+
+    try:
+        sql, params, limit = query.build(args)
+    except ValueError as e:
+        return await reply.failed(str(e))
+
+    pool = await get_pool()
+
+    async with pool.acquire() as cnx:
+        async with cnx.cursor(aiomysql.SSCursor if columnar else aiomysql.SSDictCursor) as cursor:
+            started = time.perf_counter()
+            try:
+                await cursor.execute(sql, params)
+            except Exception as e:
+                return await reply.failed(str(e))
+            finally:
+                metrics.SQL_SECONDS.observe(time.perf_counter() - started, endpoint, 'SELECT')
+
+            columns = [d[0] for d in cursor.description]
+
+            if columnar:
+                row_id = (lambda row: row[columns.index('id')]) if 'id' in columns else None
+                page = listing.Page(None, limit, row_id=row_id)
+                envelope = Envelope(columns)
+            else:
+                page = listing.Page(None, limit)
+                envelope = Envelope()
+
+            await reply.start(200, validation)
+            await reply.body(envelope.head())
+
+            while page.next is None:
+                rows = await cursor.fetchmany(flask_app.STREAM_CHUNK_SIZE)
+                if not rows:
+                    break
+
+                text = envelope.rows(page.take(query.convert(list(rows), columns)))
+                if text:
+                    await reply.body(text)
+
+    await reply.body(envelope.tail(page.envelope()), more=False)
+
+
+async def events_feed(scope, receive, reply):
+    """ app.events_feed, until the client disconnects """
+
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+
+    last_id = headers.get('last-event-id') or args.get('last_event_id')
+    keepalive = config.events.get('keepalive', 15)
+
+    client = await event_bus.subscribe(last_id)
+
+    async def stream():
+        await reply.start(200, [(b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')],
+                          mimetype='text/event-stream')
+        await reply.body('retry: {}\n\n'.format(config.events.get('retry', 3000)))
+        async for event in client.events(keepalive):
+            await reply.body(events.format_event(event))
+        await reply.body('', more=False)
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(stream()), asyncio.ensure_future(disconnected())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        event_bus.unsubscribe(client)
+        for task in tasks:
+            task.cancel()
+
+
+wsgi = WSGIMiddleware(flask_app.app, workers=config.workers.get('asgi_threads', 10))
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                flask_app.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _pool is not None:
+                    _pool.close()
+                    await _pool.wait_closed()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] in LISTS:
+        endpoint, query = LISTS[scope['path']]
+        reply = Reply(send)
+        started = time.perf_counter()
+        try:
+            return await list_endpoint(scope, reply, endpoint, query)
+        except Exception as e:
+            log.error('[asgi] {} failed: {}'.format(scope['path'], e))
+            raise
+        finally:
+            # as app.after_request, though here this includes sending the body
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, 'GET', reply.status or 500)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/api/v1/events':
+        return await events_feed(scope, receive, Reply(send))
+
+    await wsgi(scope, receive, send)
@@ -0,0 +1,74 @@
+import hashlib
+import hmac
+import os
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+import config
+import metrics
+import workers
+from cache import TTLCache
+
+# without a configured key every process makes its own, so tokens only
+# validate in the worker that issued them
+SECRET_KEY = config.auth.get('secret_key') or os.urandom(32)
+
+if isinstance(SECRET_KEY, str):
+    SECRET_KEY = SECRET_KEY.encode()
+
+# credential key -> user id, for passwords bcrypt has already accepted
+verified = TTLCache(maxsize=config.auth.get('cache_size', 1024),
+                    ttl=config.auth.get('cache_ttl', 300))
+
+_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='session-token')
+
+
+def _digest(*parts):
+    msg = b'\0'.join(p if isinstance(p, bytes) else str(p).encode() for p in parts)
+    return hmac.new(SECRET_KEY, msg, hashlib.sha256).hexdigest()
+
+
+def check_password(user, password):
+    """ bcrypt check of password against a user row, remembering successes
+
+    The cache key covers the stored hash, so changing a password makes
+    any remembered verification unreachable.
+    """
+    key = _digest(user['id'], password, user['password'])
+
+    if verified.get(key) is not None:
+        return True
+
+    with metrics.BCRYPT_SECONDS.time('verify'):
+        ok = workers.hash_pool().submit(workers.verify_password, password, user['password']).result()
+
+    if ok:
+        verified.set(key, user['id'])
+        return True
+
+    return False
+
+
+def forget_user(user_id):
+    """ drops remembered verifications for a deleted or changed user """
+    verified.discard_where(lambda cached_id: cached_id == user_id)
+
+
+def make_token(user):
+    """ a signed session token standing in for the user's password """
+    return _serializer.dumps({'id': user['id'], 'pw': _digest(user['password'])[:16]})
+
+
+def load_token(token):
+    """ returns the token's payload, or None if it is bad or expired """
+    try:
+        data = _serializer.loads(token, max_age=config.auth.get('token_max_age', 8 * 3600))
+    except BadSignature:  # includes SignatureExpired
+        return None
+
+    return data
+
+
+def token_matches(data, user):
+    """ a token is void once the user's password has changed """
+    return hmac.compare_digest(data['pw'], _digest(user['password'])[:16])
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+
+import metrics
+import workers
+from util import encode_json, write_atomic
+
+# merging chunk PDFs needs pypdf, without it each PDF is rendered in one go
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+
+class PDFCache:
+    """ Rendered PDFs on disk as <key>.pdf, evicting the least recently
+    used once they take up more than max_bytes
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.pdf')
+
+    def get(self, key):
+        """ the file holding key, or None """
+        name = self.filename(key)
+        try:
+            os.utime(name)  # marks it recently used
+        except FileNotFoundError:
+            return None
+        return name
+
+    def read(self, key):
+        name = self.get(key)
+        if name is None:
+            return None
+
+        try:
+            with open(name, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None  # evicted since
+
+    def put(self, key, pdf):
+        name = self.filename(key)
+        write_atomic(name, pdf)
+        self.evict(keep=name)
+        return name
+
+    def evict(self, keep=None):
+        """ removes old files until under max_bytes, never keep """
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.pdf') and entry.path != keep:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            if keep is not None:
+                total += os.path.getsize(keep)
+
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def _hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class CardRenderer:
+    """ Renders card templates to PDF, reusing earlier work.
+
+    A PDF is cached under a hash of its template and rows, so asking for
+    the same cards again sends the file straight back. Rows are split into
+    chunks of whole pages which are cached on their own and rendered in
+    parallel in worker processes, so after a change to one card only its
+    chunk is drawn again before the chunks are merged.
+
+    html(rows) must render the template for some rows, and runs in the
+    caller's thread as it may need the request context.
+    """
+
+    def __init__(self, cache, template_path, static_path, chunk_pages=8):
+        self.cache = cache
+        self.template_path = template_path
+        self.static_path = static_path
+        self.chunk_pages = chunk_pages
+        self._templates = {}  # name -> (mtime, hash)
+
+    def template_hash(self, name):
+        filename = os.path.join(self.template_path, name)
+        mtime = os.stat(filename).st_mtime
+
+        cached = self._templates.get(name)
+        if cached is None or cached[0] != mtime:
+            with open(filename, 'rb') as f:
+                cached = (mtime, _hash(f.read()))
+            self._templates[name] = cached
+
+        return cached[1]
+
+    def render(self, template, html, rows, cards_per_page, progress=None):
+        """ the filename of a PDF of rows drawn with template. progress(n)
+        is called as each n rows are drawn
+        """
+        progress = progress or (lambda n: None)
+        template_hash = self.template_hash(template)
+
+        key = _hash(template_hash, encode_json(rows))
+        name = self.cache.get(key)
+        if name is not None:
+            progress(len(rows))
+            return name
+
+        size = cards_per_page * self.chunk_pages
+
+        if PdfWriter is None or len(rows) <= size:
+            with metrics.PDF_SECONDS.time(template):
+                pdf = workers.job_pool().submit(workers.render_pdf, html(rows), self.static_path).result()
+            progress(len(rows))
+            return self.cache.put(key, pdf)
+
+        chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+        keys = [_hash(template_hash, encode_json(chunk)) for chunk in chunks]
+
+        pdfs = [self.cache.read(k) for k in keys]
+        progress(sum(len(chunk) for chunk, pdf in zip(chunks, pdfs) if pdf is not None))
+
+        futures = {workers.job_pool().submit(workers.render_pdf, html(chunk), self.static_path): i
+                   for i, chunk in enumerate(chunks) if pdfs[i] is None}
+
+        started = time.perf_counter()
+        for future in as_completed(futures):
+            i = futures[future]
+            pdfs[i] = future.result()
+            metrics.PDF_SECONDS.observe(time.perf_counter() - started, template)
+            self.cache.put(keys[i], pdfs[i])
+            progress(len(chunks[i]))
+
+        return self.cache.put(key, merge(pdfs))
+
+
+def merge(pdfs):
+    """ one PDF of the pages of each in pdfs """
+    writer = PdfWriter()
+    for pdf in pdfs:
+        for page in PdfReader(io.BytesIO(pdf)).pages:
+            writer.add_page(page)
+
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
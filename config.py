@@ -3,10 +3,80 @@ db = {
     'host': 'localhost',
     'database': 'sp300',
     'raise_on_warnings': True,
-    'time_zone' : '+00:00'
+    'time_zone' : '+00:00',
+
+    # connection pool, see db.py
+    'pool_size': 5,           # connections kept open
+    'pool_max_overflow': 10,  # extra connections opened under load
+    'pool_timeout': 10,       # seconds to wait for a free connection
+    'pool_health_check': 30   # ping connections idle longer than this (seconds)
+}
+
+auth = {
+    'secret_key': None,       # signs session tokens, set this when running several workers
+    'cache_size': 1024,       # remembered bcrypt verifications
+    'cache_ttl': 300,         # seconds a verification is remembered
+    'token_max_age': 8 * 3600 # seconds a session token is valid
+}
+
+qr = {
+    'cache_size': 512,        # QR code PNGs kept in memory
+    'max_age': 7 * 24 * 3600  # seconds browsers may cache them
+}
+
+encoding = {
+    # 'stdlib', 'orjson', 'ujson' or 'auto', see util.set_json_backend.
+    # only 'stdlib' keeps responses byte-for-byte as before
+    'json_backend': 'stdlib'
 }
 
 app = {
     'password_needed' : False
 
-}
\ No newline at end of file
+}
+
+workers = {
+    'hash_processes': None,   # bcrypt worker processes, None for one per core
+    'job_processes': None,    # processes for bulk jobs, None for one per core
+    'qr_threads': 2,          # threads writing QR code images
+    'asgi_threads': 10,       # threads running Flask under asgi.py
+    'user_batch_limit': 100   # most users per POST /api/v1/user/batch, each is hashed in the request
+}
+
+pdf = {
+    'cache_bytes': 200 * 1024 * 1024,  # rendered card PDFs kept in the spool
+    'chunk_pages': 8,         # pages rendered per worker process for big selections
+    # cards that fill one page, chunks must end on a page break to merge cleanly
+    'cards_per_page': {'cards.html': 8, 'devices.html': 16}
+}
+
+jobs = {
+    'spool': 'spool',         # directory for job output, relative to app.py
+    'keep': 100,              # finished jobs remembered
+    'runners': 2              # jobs running at once, the rest wait
+}
+
+search = {
+    'refresh': 300,           # seconds between full reloads of the user search index
+    'limit': 50,              # results from /api/v1/user/search unless ?limit= says otherwise
+    'suggest_limit': 10       # results from /api/v1/suggest
+}
+
+response_cache = {
+    'size': 256,              # responses kept for hot reference data, see CACHED in app.py
+    'ttl': 60                 # seconds, for changes made outside the app
+}
+
+events = {
+    'history': 1000,          # recent events kept for clients resuming with Last-Event-ID
+    'queue_size': 100,        # events waiting for one client before it is disconnected
+    'keepalive': 15,          # seconds between keepalive comments on a quiet stream
+    'retry': 3000,            # milliseconds clients wait before reconnecting
+    'poll': 0.25              # seconds between checks for events from any process
+}
+
+reservation_index = {
+    'enabled': True,          # answer collision checks from memory, see reservations.py
+    'refresh': 60,            # seconds between full reloads
+    'verify': False           # also run the SQL check and log any disagreement
+}
@@ -0,0 +1,161 @@
+import threading
+import time
+
+import mysql.connector
+
+import config
+import metrics
+from log import log
+
+# keys in config.db which configure the pool rather than the connection
+POOL_KEYS = ('pool_size', 'pool_max_overflow', 'pool_timeout', 'pool_health_check')
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """ A small pool of MySQL connections shared by every request.
+
+    Up to `size` connections are kept open between requests. When they are
+    all checked out, up to `max_overflow` extra connections are opened and
+    closed again once returned. Beyond that, checkout waits `timeout` seconds
+    for a connection to come back before raising PoolExhausted.
+
+    A connection that has sat idle for longer than `health_check` seconds is
+    pinged on checkout and reconnected if the server has dropped it.
+    """
+
+    def __init__(self, size=5, max_overflow=10, timeout=10, health_check=30, **connect_args):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.health_check = health_check
+        self.connect_args = connect_args
+
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._opened = 0
+
+        # guards _idle and _opened, notified whenever either frees up
+        self._available = threading.Condition()
+
+    def _connect(self):
+        return mysql.connector.connect(**self.connect_args)
+
+    def _checked(self, cnx, returned_at):
+        """ make sure an idle connection is still usable """
+        if time.monotonic() - returned_at < self.health_check:
+            return cnx
+
+        try:
+            cnx.ping(reconnect=True, attempts=1)
+        except Exception:
+            log.warning('[pool] Dropping dead connection.')
+            self._discard(cnx)
+            cnx = self._open()
+            if cnx is None:
+                raise PoolExhausted('Could not replace a dead connection')
+
+        return cnx
+
+    def _open(self):
+        with self._available:
+            if self._opened >= self.size + self.max_overflow:
+                return None
+            self._opened += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+
+    def _discard(self, cnx):
+        with self._available:
+            self._opened -= 1
+            self._available.notify()
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        """ returns a connection, opening one if none are idle """
+        with metrics.POOL_WAIT_SECONDS.time():
+            return self._checkout()
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            with self._available:
+                # size + overflow reached, wait for one to be given back or discarded
+                while not self._idle and self._opened >= self.size + self.max_overflow:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhausted('No database connection free after {}s'.format(self.timeout))
+                    self._available.wait(remaining)
+
+                idle = self._idle.pop() if self._idle else None
+
+            if idle is not None:
+                return self._checked(*idle)
+
+            # another thread may have taken the free place first
+            cnx = self._open()
+            if cnx is not None:
+                return cnx
+
+    def checkin(self, cnx):
+        """ gives a connection back, discarding any uncommitted work """
+        try:
+            cnx.rollback()
+        except Exception:
+            self._discard(cnx)
+            return
+
+        with self._available:
+            if len(self._idle) < self.size:
+                self._idle.append((cnx, time.monotonic()))
+                self._available.notify()
+                return
+
+        # pool is full, this was an overflow connection
+        self._discard(cnx)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """ the process wide pool, created on first use so that each worker
+    process opens its own connections
+    """
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                connect_args = {k: v for k, v in config.db.items() if k not in POOL_KEYS}
+                _pool = ConnectionPool(size=config.db.get('pool_size', 5),
+                                       max_overflow=config.db.get('pool_max_overflow', 10),
+                                       timeout=config.db.get('pool_timeout', 10),
+                                       health_check=config.db.get('pool_health_check', 30),
+                                       **connect_args)
+    return _pool
+
+
+def fetch_sets(cursor, sql, params=()):
+    """ runs several ;-separated statements in one round trip and returns
+    the rows of each one that gives any, in order
+    """
+    if hasattr(cursor, 'fetchsets'):
+        # connector 9.2 and later
+        cursor.execute(sql, params)
+        return [rows for _, rows in cursor.fetchsets()]
+
+    return [result.fetchall() for result in cursor.execute(sql, params, multi=True) if result.with_rows]
@@ -0,0 +1,308 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from log import log
+from util import encode_json
+
+
+class EventLog:
+    """ Change events in a SQLite file in the spool, written and read by
+    every server process, so a client sees changes made through any of
+    them. The latest `history` events are kept for clients resuming with
+    the last id they saw.
+
+    Ids are <epoch>-<n>, with n the event's row and an epoch made with the
+    file, so an id from a deleted log is never mistaken for a new one.
+
+    publish() also bumps the 'event' counter of versions, a TableVersions,
+    so readers watch a counter in shared memory and only read the file
+    when something was published.
+    """
+
+    def __init__(self, path, versions, history=1000):
+        self.path = path
+        self.versions = versions
+        self.history = history
+        self._local = threading.local()
+        self._epoch = None
+
+    def _db(self):
+        """ a connection for this thread, the file is only opened on first use """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(""" CREATE TABLE IF NOT EXISTS event (
+                               n INTEGER PRIMARY KEY AUTOINCREMENT,
+                               kind TEXT, data TEXT, created_at REAL); """)
+            db.execute(""" CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT); """)
+            db.execute(""" INSERT OR IGNORE INTO meta VALUES ('epoch', ?); """, (os.urandom(4).hex(),))
+            self._local.db = db
+        return db
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            self._epoch = self._db().execute(""" SELECT value FROM meta WHERE key = 'epoch'; """).fetchone()[0]
+        return self._epoch
+
+    def version(self):
+        """ changes whenever an event is published """
+        return self.versions.get('event')
+
+    def publish(self, kind, data):
+        self.publish_many([(kind, data)])
+
+    def publish_many(self, events):
+        """ publishes (kind, data) pairs in one transaction """
+        if not events:
+            return
+
+        db = self._db()
+        now = time.time()
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for kind, data in events:
+                n = db.execute(""" INSERT INTO event (kind, data, created_at) VALUES (?, ?, ?); """,
+                               (kind, encode_json(data), now)).lastrowid
+            db.execute(""" DELETE FROM event WHERE n <= ?; """, (n - self.history,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        self.versions.bump('event')
+
+    def last(self):
+        """ n of the latest event, 0 if there are none """
+        return self._db().execute(""" SELECT COALESCE(MAX(n), 0) FROM event; """).fetchone()[0]
+
+    def after(self, n, until=None):
+        """ events after n, and up to until, as (id, kind, data) """
+        rows = self._db().execute(""" SELECT n, kind, data FROM event
+                                      WHERE n > ? AND n <= ?
+                                      ORDER BY n; """,
+                                  (n, until if until is not None else 2 ** 62)).fetchall()
+        return [('{}-{}'.format(self.epoch, n), kind, data) for n, kind, data in rows]
+
+    def position(self, last_id, until):
+        """ n of last_id if every event after it up to until is still
+        known, otherwise None
+        """
+        epoch, _, n = (last_id or '').partition('-')
+        if epoch != self.epoch or not n.isdigit() or int(n) > until:
+            return None
+
+        n = int(n)
+        if n < until:
+            first = self._db().execute(""" SELECT MIN(n) FROM event; """).fetchone()[0]
+            if first is None or first > n + 1:
+                return None
+        return n
+
+
+def _n(event):
+    return int(event[0].rpartition('-')[2])
+
+
+class _Fanout:
+    """ The clients of one process and where in the log they are up to,
+    shared by EventBus and AsyncEventBus. Each client has a queue of at most
+    queue_size events; a client too slow to keep up is evicted rather than
+    holding events for ever, its stream ends and it can reconnect with the
+    last id it saw.
+    """
+
+    Full = None
+
+    def __init__(self, log, queue_size=100, poll=0.25):
+        self.log = log
+        self.queue_size = queue_size
+        self.poll = poll
+        self._clients = set()
+        self._version = None    # log version when _position was read
+        self._position = None   # n of the last event handed to clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def publish(self, kind, data):
+        self.log.publish(kind, data)
+
+    def publish_many(self, events):
+        self.log.publish_many(events)
+
+    def _deliver(self, events):
+        for event in events:
+            for client in list(self._clients):
+                try:
+                    client.queue.put_nowait(event)
+                except self.Full:
+                    client.evicted = True
+                    self._clients.discard(client)
+
+        if events:
+            self._position = _n(events[-1])
+
+    def _missed(self, last_id):
+        """ the events a client resuming from last_id needs before the next
+        ones delivered, or a 'reset' event if they are no longer all known
+        """
+        n = self.log.position(last_id, self._position)
+        if n is None:
+            return [(None, 'reset', '{}')]
+
+        missed = self.log.after(n, self._position)
+        if len(missed) > self.queue_size:
+            return [(None, 'reset', '{}')]
+        return missed
+
+    def _subscribed(self, client, missed):
+        for event in missed:
+            client.queue.put_nowait(event)
+        self._clients.add(client)
+        return client
+
+
+class Subscription:
+    """ One client's feed: a bounded queue of (id, kind, data) events """
+
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.evicted = False
+
+    def events(self, keepalive=15):
+        """ yields events as they arrive, or None after keepalive quiet
+        seconds. Ends once evicted and its queue is drained.
+        """
+        while True:
+            try:
+                yield self.queue.get(timeout=keepalive)
+            except queue.Empty:
+                if self.evicted:
+                    return
+                yield None
+
+
+class EventBus(_Fanout):
+    """ Sends the events of an EventLog to this process's clients, each
+    read by a thread. One thread watches the log for all of them.
+    """
+
+    Full = queue.Full
+
+    def __init__(self, log, queue_size=100, poll=0.25):
+        super().__init__(log, queue_size, poll)
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def subscribe(self, last_id=None):
+        """ a new Subscription. With last_id, the events since are queued
+        first, or a 'reset' event telling the client to read everything
+        again.
+        """
+        with self._lock:
+            if self._watcher is None:
+                self._version = self.log.version()
+                self._position = self.log.last()
+                self._watcher = threading.Thread(name='events', target=self._watch, daemon=True)
+                self._watcher.start()
+
+            missed = self._missed(last_id) if last_id else []
+            return self._subscribed(Subscription(self.queue_size), missed)
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll)
+
+            version = self.log.version()
+            if version == self._version:
+                continue
+
+            try:
+                with self._lock:
+                    self._deliver(self.log.after(self._position))
+                    self._version = version
+            except Exception as e:
+                log.error('[events] Could not read events: {}'.format(e))
+
+
+class AsyncSubscription:
+    """ Subscription for a client served on an asyncio event loop """
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.evicted = False
+
+    async def events(self, keepalive=15):
+        while True:
+            try:
+                yield await asyncio.wait_for(self.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                if self.evicted:
+                    return
+                yield None
+
+
+class AsyncEventBus(_Fanout):
+    """ EventBus for clients on an asyncio event loop, as under asgi.py, so
+    an open stream holds no thread. The log is read in a thread, but only
+    when its counter moves.
+    """
+
+    Full = asyncio.QueueFull
+
+    def __init__(self, log, queue_size=100, poll=0.25):
+        super().__init__(log, queue_size, poll)
+        self._lock = None
+        self._watcher = None
+
+    async def subscribe(self, last_id=None):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._watcher is None:
+                self._version = self.log.version()
+                self._position = await asyncio.to_thread(self.log.last)
+                self._watcher = asyncio.ensure_future(self._watch())
+
+            missed = await asyncio.to_thread(self._missed, last_id) if last_id else []
+            return self._subscribed(AsyncSubscription(self.queue_size), missed)
+
+    def unsubscribe(self, client):
+        self._clients.discard(client)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll)
+
+            version = self.log.version()
+            if version == self._version:
+                continue
+
+            try:
+                async with self._lock:
+                    self._deliver(await asyncio.to_thread(self.log.after, self._position))
+                    self._version = version
+            except Exception as e:
+                log.error('[events] Could not read events: {}'.format(e))
+
+
+def format_event(event):
+    """ an event as server-sent events text, None for a keepalive comment """
+    if event is None:
+        return ': keepalive\n\n'
+
+    id, kind, data = event
+    lines = [] if id is None else ['id: ' + id]
+    return '\n'.join(lines + ['event: ' + kind, 'data: ' + data]) + '\n\n'
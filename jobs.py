@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+
+import workers
+from log import log
+
+# ids handed to a worker process at a time
+CHUNK_SIZE = 50
+
+
+class Job:
+    """ A long running task, with progress for clients polling
+    GET /api/v1/jobs/<id>
+    """
+
+    def __init__(self, kind, total):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.total = total
+        self.done = 0
+        self.failures = {}   # item -> error message
+        self.result = None   # path of the output file, if any
+        self.error = None
+        self.pid = os.getpid()
+        self.created_at = time.time()
+        self.finished_at = None
+        self.registry = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def save(self):
+        """ records progress so far, for other processes to see """
+        if self.registry is not None:
+            self.registry.save(self)
+
+    def to_dict(self):
+        return dict(id=self.id,
+                    kind=self.kind,
+                    status=self.status,
+                    total=self.total,
+                    done=self.done,
+                    failures=[dict(id=k, error=v) for k, v in sorted(self.failures.items())],
+                    error=self.error,
+                    download=self.result is not None)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobRegistry:
+    """ Jobs recorded in a SQLite file in the spool, so every server process
+    can report on them and their output outlives a restart. The oldest
+    finished jobs beyond keep are forgotten, along with their files.
+
+    Jobs run on a pool of `runners` threads, which hand the heavy work on
+    to workers.job_pool(); more jobs than that wait their turn as queued.
+    A job whose process has gone away before it finished shows as failed.
+    """
+
+    def __init__(self, path, keep=100, runners=2):
+        self.path = path
+        self.keep = keep
+        self._jobs = {}      # id -> Job, unfinished jobs of this process
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._runner = ThreadPoolExecutor(max_workers=runners, thread_name_prefix='job')
+
+    def _db(self):
+        """ a connection for this thread, the file is only opened on first use """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(""" CREATE TABLE IF NOT EXISTS job (
+                               id TEXT PRIMARY KEY, kind TEXT, status TEXT,
+                               total INTEGER, done INTEGER, failures TEXT,
+                               result TEXT, error TEXT, pid INTEGER,
+                               created_at REAL, finished_at REAL); """)
+            self._local.db = db
+        return db
+
+    def save(self, job):
+        with self._lock:
+            self._db().execute(""" INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?); """,
+                               (job.id, job.kind, job.status, job.total, job.done,
+                                json.dumps(sorted(job.failures.items())), job.result, job.error,
+                                job.pid, job.created_at, job.finished_at))
+
+    def add(self, job):
+        job.registry = self
+        self._jobs[job.id] = job
+        job.save()
+
+        db = self._db()
+        old = db.execute(""" SELECT id, result FROM job
+                             WHERE status IN ('done', 'failed')
+                             ORDER BY finished_at DESC
+                             LIMIT -1 OFFSET ?; """, (self.keep,)).fetchall()
+
+        for id, result in old:
+            db.execute(""" DELETE FROM job WHERE id = ?; """, (id,))
+            if result is not None:
+                try:
+                    os.remove(result)
+                except FileNotFoundError:
+                    pass
+
+        return job
+
+    def get(self, id):
+        job = self._jobs.get(id)
+        if job is not None:
+            return job
+
+        row = self._db().execute(""" SELECT kind, status, total, done, failures, result, error,
+                                            pid, created_at, finished_at
+                                     FROM job WHERE id = ?; """, (id,)).fetchone()
+        if row is None:
+            return None
+
+        job = Job(row[0], row[2])
+        job.id = id
+        job.status = row[1]
+        (job.done, failures, job.result, job.error,
+         job.pid, job.created_at, job.finished_at) = row[3:]
+        job.failures = {k: v for k, v in json.loads(failures)}
+
+        if not job.finished and (job.pid == os.getpid() or not _alive(job.pid)):
+            job.status = 'failed'
+            job.error = 'interrupted'
+
+        return job
+
+    def run(self, job, target, *args):
+        """ runs target(job, *args) once a runner is free """
+        def run():
+            job.status = 'running'
+            job.save()
+            try:
+                target(job, *args)
+            except Exception as e:
+                log.error('[job] {} {} failed: {}'.format(job.kind, job.id, e))
+                job.error = str(e)
+                job.status = 'failed'
+            else:
+                job.status = 'done'
+            finally:
+                job.finished_at = time.time()
+                job.save()
+                self._jobs.pop(job.id, None)
+
+        self._runner.submit(run)
+        return job
+
+
+def _chunks(ids):
+    ids = iter(ids)
+    chunk = list(islice(ids, CHUNK_SIZE))
+    while chunk:
+        yield chunk
+        chunk = list(islice(ids, CHUNK_SIZE))
+
+
+def qr_files(job, ids, path, overwrite):
+    """ writes a QR code image per id, spread over worker processes """
+    futures = {workers.job_pool().submit(workers.qr_files, chunk, path, overwrite): chunk
+               for chunk in _chunks(ids)}
+
+    for future in as_completed(futures):
+        job.failures.update(future.result())
+        job.done += len(futures[future])
+        job.save()
+
+
+def qr_zip(job, ids, zip_path):
+    """ draws QR codes in worker processes into one zip of <id>.png files """
+    futures = {workers.job_pool().submit(workers.qr_pngs, chunk): chunk
+               for chunk in _chunks(ids)}
+
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as archive:
+        for future in as_completed(futures):
+            pngs, failures = future.result()
+            for i, png in sorted(pngs.items()):
+                archive.writestr('{}.png'.format(i), png)
+            job.failures.update(failures)
+            job.done += len(futures[future])
+            job.save()
+
+    job.result = zip_path
+
+
+def card_pdf(job, render, rows, pdf_path):
+    """ renders cards for rows with render(rows, progress), which returns
+    the file it made, and keeps a copy at pdf_path for download
+    """
+    def progress(n):
+        job.done += n
+        job.save()
+
+    shutil.copyfile(render(rows, progress), pdf_path)
+    job.result = pdf_path
@@ -0,0 +1,209 @@
+import base64
+import json
+from operator import itemgetter
+
+from dateutil.parser import parse as date_parse
+from datetime import timezone
+
+from util import date_indices, dict_dates_to_utc
+
+# most rows a client may ask for in one page
+MAX_LIMIT = 1000
+
+
+def encode_cursor(last_id):
+    """ an opaque token for the page after last_id """
+    text = json.dumps({'after': last_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded.encode()).decode())['after'])
+    except Exception:
+        raise ValueError('invalid cursor')
+
+
+class ListQuery:
+    """ Builds the SELECT behind a list endpoint from its query string.
+
+    ?fields=a,b         only these columns
+    ?after=<cursor>     rows after the page a previous response ended on
+    ?limit=n            at most n rows, ordered by id, with a "next" cursor
+    ?<filter>=value     equality on the table's filter columns ('null' for NULL,
+                        'true' and 'false' for 1 and 0)
+    ?from=&to=          a range on the table's date column
+
+    Columns and filters come from fixed lists, so only values are
+    parameters and everything is pushed down into SQL.
+
+    converters maps column names to functions applied to their values, and
+    with utc_dates the date_keys columns are marked as UTC.
+    """
+
+    def __init__(self, table, columns, default_columns=None, filters=(), date_column=None,
+                 converters=None, utc_dates=False):
+        self.table = table
+        self.columns = columns
+        self.default_columns = default_columns
+        self.filters = filters
+        self.date_column = date_column
+        self.converters = converters or {}
+        self.utc_dates = utc_dates
+
+    def convert(self, rows, columns):
+        """ applies converters to a chunk of rows, which are dicts or tuples
+        in the order of columns, and returns it
+        """
+        if not rows:
+            return rows
+
+        if isinstance(rows[0], dict):
+            for column, function in self.converters.items():
+                if column in columns:
+                    for row in rows:
+                        row[column] = function(row[column])
+            if self.utc_dates:
+                dict_dates_to_utc(rows)
+            return rows
+
+        functions = [(i, self.converters[c]) for i, c in enumerate(columns) if c in self.converters]
+        if self.utc_dates:
+            functions += [(i, _utc) for i in date_indices(columns)]
+
+        if not functions:
+            return rows
+
+        rows = [list(row) for row in rows]
+        for i, function in functions:
+            for row in rows:
+                row[i] = function(row[i])
+        return rows
+
+    def build(self, args):
+        """ returns (sql, params, limit) or raises ValueError """
+        where = []
+        params = []
+
+        if args.get('fields'):
+            fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+            unknown = [f for f in fields if f not in self.columns]
+            if unknown:
+                raise ValueError('unknown fields: {}'.format(', '.join(unknown)))
+        else:
+            fields = self.default_columns
+
+        limit = None
+        if args.get('limit'):
+            limit = int(args['limit'])
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError('limit must be between 1 and {}'.format(MAX_LIMIT))
+
+            # paging needs the id of the last row
+            if fields is not None and 'id' not in fields:
+                fields = ['id'] + fields
+
+        if args.get('after'):
+            where.append('id > %s')
+            params.append(decode_cursor(args['after']))
+
+        for name in self.filters:
+            value = args.get(name)
+            if value is None:
+                continue
+            if value.lower() == 'null':
+                where.append('`{}` IS NULL'.format(name))
+            else:
+                value = {'true': 1, 'false': 0}.get(value.lower(), value)
+                where.append('`{}` = %s'.format(name))
+                params.append(value)
+
+        if self.date_column is not None:
+            for arg, op in (('from', '>='), ('to', '<')):
+                if args.get(arg):
+                    d = date_parse(args[arg])
+                    if d.tzinfo is not None:
+                        d = d.astimezone(timezone.utc).replace(tzinfo=None)
+                    where.append('`{}` {} %s'.format(self.date_column, op))
+                    params.append(d)
+
+        sql = 'SELECT {} FROM `{}`'.format(
+            '*' if fields is None else ', '.join('`{}`'.format(f) for f in fields), self.table)
+
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        if limit is not None or args.get('after'):
+            sql += ' ORDER BY id'
+
+        if limit is not None:
+            # one extra row tells us whether there is a next page
+            sql += ' LIMIT %s'
+            params.append(limit + 1)
+
+        return sql, params, limit
+
+
+class Page:
+    """ Passes chunks of rows through, stopping after limit rows, and
+    remembers the cursor for the following page
+    """
+
+    def __init__(self, chunks, limit, row_id=itemgetter('id')):
+        self.chunks = chunks
+        self.limit = limit
+        self.row_id = row_id
+        self.next = None
+
+        self._sent = 0
+        self._last_id = None
+
+    def __iter__(self):
+        for rows in self.chunks:
+            yield self.take(rows)
+
+            if self.next is not None:
+                return
+
+    def take(self, rows):
+        """ the part of the next chunk of rows to send. Once next is set,
+        the page is full and no more should be sent.
+        """
+        if self.limit is not None:
+            if self._sent + len(rows) > self.limit:
+                rows = rows[:self.limit - self._sent]
+                self.next = encode_cursor(self.row_id(rows[-1]) if rows else self._last_id)
+            self._sent += len(rows)
+            if rows:
+                self._last_id = self.row_id(rows[-1])
+
+        return rows
+
+    def envelope(self):
+        """ extra keys for the response envelope """
+        return {'next': self.next} if self.limit is not None else {}
+
+
+def _utc(d):
+    return d.replace(tzinfo=timezone.utc) if d is not None else None
+
+
+users = ListQuery('user', ('id', 'email', 'fname', 'lname', 'type', 'created_at'),
+                  default_columns=['id', 'email', 'fname', 'lname', 'type', 'created_at'],
+                  filters=('type',))
+
+devices = ListQuery('device', ('id', 'serial_no', 'type', 'is_active', 'loaned_by'),
+                    filters=('type', 'loaned_by', 'is_active'),
+                    converters={'is_active': bool})
+
+reservations = ListQuery('reservation', ('id', 'start_time', 'end_time', 'class_id', 'type',
+                                         'count', 'user_id', 'safe_zone'),
+                         filters=('type', 'class_id', 'user_id'), date_column='start_time',
+                         utc_dates=True)
+
+classes = ListQuery('class', ('id', 'name'))
+
+lateness = ListQuery('lateness', ('id', 'user_id', 'datetime'),
+                     filters=('user_id',), date_column='datetime',
+                     utc_dates=True)
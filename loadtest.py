@@ -0,0 +1,103 @@
+""" A small load test for comparing ways of serving the API, e.g.
+
+    python loadtest.py http://localhost:8000 --clients 50 --seconds 30
+
+hits a mix of read endpoints from many threads and prints requests per
+second and latency percentiles for each. Run it against app.wsgi under
+gunicorn and asgi.py under uvicorn with the same database to compare.
+
+With --loan DEVICE:USER each client instead lends that device to that
+user and returns it again, timing the checkout desk's PUT and DELETE.
+"""
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+PATHS = ['/api/v1/device', '/api/v1/device/type', '/api/v1/reservation?limit=100',
+         '/api/v1/class', '/api/v1/user?limit=100', '/api/v1/config']
+
+
+def client(base, paths, until, results, etags):
+    i = 0
+    while time.monotonic() < until:
+        method, path = paths[i % len(paths)]
+        i += 1
+
+        request = urllib.request.Request(base + path, method=method)
+        if etags and path in etags:
+            request.add_header('If-None-Match', etags[path])
+
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                status = response.status
+                if etags is not None and response.headers.get('ETag'):
+                    etags[path] = response.headers['ETag']
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = 'error'
+
+        results[(method, path)].append((time.perf_counter() - started, status))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base', help='e.g. http://localhost:8000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--revalidate', action='store_true',
+                        help='send If-None-Match like a polling client')
+    parser.add_argument('--loan', metavar='DEVICE:USER',
+                        help='lend and return a device instead of reading')
+    args = parser.parse_args()
+
+    if args.loan:
+        device_id, user_id = args.loan.split(':')
+        path = '/api/v1/device/{}/loan/{}'.format(device_id, user_id)
+        paths = [('PUT', path), ('DELETE', path)]
+    else:
+        paths = [('GET', path) for path in PATHS]
+
+    results = defaultdict(list)
+    until = time.monotonic() + args.seconds
+
+    threads = [threading.Thread(target=client,
+                                args=(args.base.rstrip('/'), paths[i % len(paths):] + paths[:i % len(paths)],
+                                      until, results, {} if args.revalidate else None))
+               for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{:42} {:>8} {:>8} {:>8} {:>8}  {}'.format('request', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses'))
+
+    for method, path in paths:
+        times = sorted(t for t, _ in results[(method, path)])
+        if not times:
+            continue
+
+        statuses = defaultdict(int)
+        for _, status in results[(method, path)]:
+            statuses[status] += 1
+
+        print('{:42} {:8.1f} {:8.1f} {:8.1f} {:8.1f}  {}'.format(
+            method + ' ' + path, len(times) / args.seconds,
+            percentile(times, 0.50) * 1000, percentile(times, 0.95) * 1000, percentile(times, 0.99) * 1000,
+            dict(statuses)))
+
+    total = sum(len(r) for r in results.values())
+    print('total {:.1f} req/s'.format(total / args.seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+from log import log
+from reservations import peak_reserved
+
+# error_message values sent back by the loan endpoints
+NOT_PRIVILEGED = 1
+ALREADY_LOANED = 2
+UNSAFE = 3
+
+# most (device, user) pairs accepted by the batch endpoints
+MAX_BATCH = 500
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+class LoanEngine:
+    """ Checks and applies loans inside the caller's transaction.
+
+    prepare() reads every fact needed with two queries, locking the device
+    rows with SELECT ... FOR UPDATE, so two scanners can't lend the same
+    device. Nothing is written until lend(); the caller commits or rolls
+    back.
+
+    colliding(type) must return the reservations colliding with `now`.
+    """
+
+    def __init__(self, cursor, now, colliding):
+        self.cursor = cursor
+        self.now = now
+        self.colliding = colliding
+
+        self.devices = {}      # device id -> row
+        self.privileges = {}   # user id -> set of types
+        self._reservations = {}
+        self._classes = {}
+        self._safety = {}      # (user id, type) -> check_safety result
+
+    def prepare(self, device_ids, user_ids):
+        self.lock_devices(device_ids)
+        self.load_privileges(user_ids)
+
+    def lock_devices(self, device_ids):
+        device_ids = sorted(set(device_ids))
+
+        self.cursor.execute(""" SELECT device.id, device.type, device.loaned_by,
+                                       (SELECT COUNT(*) FROM device AS active
+                                        WHERE active.type = device.type
+                                        AND active.is_active = 1) AS total_devices
+                                FROM device
+                                WHERE device.id IN ({})
+                                FOR UPDATE; """.format(_placeholders(device_ids)), device_ids)
+
+        self.devices = {row['id']: row for row in self.cursor.fetchall()}
+
+    def load_privileges(self, user_ids):
+        user_ids = sorted(set(user_ids))
+
+        self.cursor.execute(""" SELECT user_id, type FROM device_type_privilage
+                                WHERE user_id IN ({}); """.format(_placeholders(user_ids)), user_ids)
+
+        self.privileges = {user_id: set() for user_id in user_ids}
+        for row in self.cursor.fetchall():
+            self.privileges[row['user_id']].add(row['type'])
+
+    def reservations(self, type):
+        if type not in self._reservations:
+            self._reservations[type] = self.colliding(type)
+        return self._reservations[type]
+
+    def user_classes(self, user_id):
+        if user_id not in self._classes:
+            self.cursor.execute(""" SELECT class_id FROM class_registration WHERE user_id = %s """, (user_id,))
+            self._classes[user_id] = set(row['class_id'] for row in self.cursor.fetchall())
+        return self._classes[user_id]
+
+    def loaner(self, user_id):
+        self.cursor.execute(""" SELECT user.id, user.email, user.fname,
+                                user.lname, user.type, user.created_at
+                                FROM user
+                                WHERE user.id = %s; """, (user_id,))
+        return self.cursor.fetchone()
+
+    def check(self, device_id, user_id):
+        """ returns None if user_id may borrow device_id, otherwise
+        (error_message, data) for make_failed_response
+        """
+        device = self.devices.get(device_id)
+
+        # is user privileged for this device?
+        if device is None or device['type'] not in self.privileges.get(user_id, ()):
+            log.info('[check] [privilege] User {} not privileged to loan device {}'.format(user_id, device_id))
+            return NOT_PRIVILEGED, None
+
+        # is the device loaned by a user?
+        if device['loaned_by'] is not None:
+            log.info('[check] [loan] Device {} already loaned.'.format(device_id))
+            return ALREADY_LOANED, self.loaner(device['loaned_by'])
+
+        group = (user_id, device['type'])
+        if group not in self._safety:
+            self._safety[group] = self.check_safety(device['type'], user_id)
+
+        return self._safety[group]
+
+    def check_safety(self, type, user_id):
+        """ will lending one more device of type to user_id leave enough
+        for the reservations happening now?
+        """
+        colliding_reservations = self.reservations(type)
+
+        total_devices = self.devices_of_type(type)
+        total_reserved = peak_reserved(colliding_reservations, self.now, self.now)
+
+        remaining = total_devices - total_reserved - 1
+
+        log.info('[check] [safety] Type {}: {} active, {} reserved, {} left after loan'.format(
+            type, total_devices, total_reserved, remaining))
+
+        if remaining >= 0:
+            return None
+
+        # there are plainly no active unloaned devices left, even if there
+        # are no reservations. ideally this never happens, as an inactive
+        # and unloaned device wouldn't normally be requested
+        if len(colliding_reservations) == 0:
+            log.info('[check] [safety] Failed, remaining = {}'.format(remaining))
+            return UNSAFE, None
+
+        # now only allow if student is in one of the classes of any of the colliding reservations
+        reservation_classes = set(row['class_id'] for row in colliding_reservations)
+        common_classes = self.user_classes(user_id).intersection(reservation_classes)
+
+        if len(common_classes) == 0:
+            log.info('[check] [safety] Failed. common classes = 0')
+            return UNSAFE, colliding_reservations
+
+        return None
+
+    def check_many(self, pairs):
+        """ checks (device_id, user_id) pairs in order, returning a failure
+        or None for each. Safety is worked out once per (user, type), and a
+        device passing earlier in the list counts as loaned for later ones.
+        """
+        results = []
+
+        for device_id, user_id in pairs:
+            failure = self.check(device_id, user_id)
+
+            if failure is None:
+                self.devices[device_id]['loaned_by'] = user_id
+
+            results.append(failure)
+
+        return results
+
+    def devices_of_type(self, type):
+        for device in self.devices.values():
+            if device['type'] == type:
+                return device['total_devices']
+        return 0
+
+    def lend(self, pairs):
+        """ loans each (device_id, user_id) with one UPDATE, returns the
+        number of devices lent
+        """
+        if not pairs:
+            return 0
+
+        cases = ' '.join(['WHEN %s THEN %s'] * len(pairs))
+        params = [value for pair in pairs for value in pair]
+        device_ids = [device_id for device_id, _ in pairs]
+
+        self.cursor.execute(""" UPDATE device
+                                SET loaned_by = CASE id {} END
+                                WHERE id IN ({})
+                                AND loaned_by IS NULL; """.format(cases, _placeholders(device_ids)),
+                            params + device_ids)
+
+        for device_id, user_id in pairs:
+            self.devices[device_id]['loaned_by'] = user_id
+
+        return self.cursor.rowcount
+
+    def give_back(self, pairs):
+        """ returns devices with one UPDATE, after lock_devices(). Gives
+        True for each pair where user_id had device_id.
+        """
+        valid = []
+        results = []
+
+        for device_id, user_id in pairs:
+            device = self.devices.get(device_id)
+            ok = device is not None and device['loaned_by'] == user_id
+
+            if ok:
+                device['loaned_by'] = None
+                valid.append(device_id)
+
+            results.append(ok)
+
+        if valid:
+            self.cursor.execute(""" UPDATE device
+                                    SET loaned_by = NULL
+                                    WHERE id IN ({}); """.format(_placeholders(valid)), valid)
+
+        return results
@@ -0,0 +1,48 @@
+import hashlib
+import os
+
+import metrics
+from cache import TTLCache
+from util import qr_png, write_atomic
+
+# part of every ETag, change it whenever util.qr_png draws codes differently
+RENDER_VERSION = b'qr-h-10-0'
+
+
+class QRStore:
+    """ QR code PNGs for user and device ids, drawn on first request.
+
+    Images live on disk as <id>.png in path, so existing files and links
+    keep working, and missing ones are drawn and saved when first asked
+    for. The most recently used PNGs are also kept in memory.
+
+    A code's bytes depend only on its id and how it is drawn, so the ETag
+    is a hash of those and never needs the image to be read.
+    """
+
+    def __init__(self, path, cache_size=512):
+        self.path = path
+        self.hot = TTLCache(maxsize=cache_size, ttl=None)
+
+    def filename(self, id):
+        return os.path.join(self.path, '{}.png'.format(id))
+
+    def etag(self, id):
+        return hashlib.sha1(RENDER_VERSION + b':' + str(id).encode()).hexdigest()
+
+    def get(self, id):
+        """ the PNG bytes for id """
+        png = self.hot.get(id)
+        if png is not None:
+            return png
+
+        try:
+            with open(self.filename(id), 'rb') as f:
+                png = f.read()
+        except FileNotFoundError:
+            with metrics.QR_SECONDS.time('request'):
+                png = qr_png(id)
+                write_atomic(self.filename(id), png)
+
+        self.hot.set(id, png)
+        return png
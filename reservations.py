@@ -0,0 +1,258 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from versions import Seen
+
+_EARLIEST = datetime.min
+
+
+def naive_utc(d):
+    """ the database stores naive UTC datetimes, so compare in those """
+    if d.tzinfo is not None:
+        d = d.astimezone(timezone.utc).replace(tzinfo=None)
+    return d
+
+
+def effective_start(row):
+    """ a reservation blocks devices from safe_zone before it starts """
+    safe_zone = row.get('safe_zone') or timedelta(0)
+    return naive_utc(row['start_time']) - safe_zone
+
+
+class _Node:
+    __slots__ = ('key', 'end', 'value', 'priority', 'left', 'right', 'max_end')
+
+    def __init__(self, key, end, value):
+        self.key = key
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+
+def _max_end(node):
+    return node.max_end if node is not None else _EARLIEST
+
+
+def _update(node):
+    node.max_end = max(node.end, _max_end(node.left), _max_end(node.right))
+
+
+def _split(node, key, inclusive=False):
+    """ splits a treap into keys before `key` and the rest; with inclusive,
+    `key` itself goes to the left part
+    """
+    if node is None:
+        return None, None
+
+    if node.key < key or (inclusive and node.key == key):
+        left, right = _split(node.right, key, inclusive)
+        node.right = left
+        _update(node)
+        return node, right
+
+    left, right = _split(node.left, key, inclusive)
+    node.left = right
+    _update(node)
+    return left, node
+
+
+def _merge(a, b):
+    """ joins two treaps where every key in a is before every key in b """
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+class IntervalTree:
+    """ Intervals [start, end] in a treap ordered by start, where every node
+    also knows the latest end beneath it. Finding the intervals that
+    overlap a window takes O(log n + k).
+    """
+
+    def __init__(self):
+        self._root = None
+
+    def insert(self, start, end, key, value):
+        left, right = _split(self._root, (start, key))
+        self._root = _merge(_merge(left, _Node((start, key), end, value)), right)
+
+    def remove(self, start, key):
+        left, right = _split(self._root, (start, key))
+        _, right = _split(right, (start, key), inclusive=True)
+        self._root = _merge(left, right)
+
+    def overlapping(self, lo, hi):
+        """ values of intervals with start < hi and end >= lo """
+        found = []
+        self._collect(self._root, lo, hi, found)
+        return found
+
+    def _collect(self, node, lo, hi, found):
+        while node is not None and node.max_end >= lo:
+            self._collect(node.left, lo, hi, found)
+
+            if node.key[0] >= hi:
+                return  # so does everything to the right
+
+            if node.end >= lo:
+                found.append(node.value)
+
+            node = node.right
+
+
+class ReservationIndex:
+    """ Reservations kept in memory, one interval tree per device type,
+    so collision checks don't scan the reservation table.
+
+    Rows are loaded on first use and kept up to date by add() and remove()
+    as this process writes. Writes by other processes are picked up from
+    the table's change counter in versions.TableVersions (see is_current)
+    and by a full reload every `refresh` seconds.
+    """
+
+    def __init__(self, refresh=60):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._trees = {}   # type -> IntervalTree
+        self._rows = {}    # id -> row
+        self._max_id = 0
+        self._seen = Seen()
+        self.loaded_at = None
+
+    @property
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh
+
+    def invalidate(self):
+        """ forces a reload on next use, e.g. after a cascading delete """
+        with self._lock:
+            self.loaded_at = None
+
+    def load(self, cursor, version=None):
+        """ loads every reservation. version is the table's counter, read
+        before the rows so a write in between triggers another load
+        """
+        cursor.execute(""" SELECT * FROM reservation; """)
+        rows = cursor.fetchall()
+
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(row)
+            self._seen.reset(version)
+            self.loaded_at = time.monotonic()
+
+    def is_current(self, cursor, version):
+        """ whether the table changed under us: its counter has only moved
+        for our own writes, and its highest id, found through the primary
+        key, matches, which also catches rows added outside the app
+        """
+        with self._lock:
+            if not self._seen.matches(version):
+                return False
+
+        cursor.execute(""" SELECT MAX(id) AS max_id FROM reservation; """)
+        row = cursor.fetchone()
+
+        with self._lock:
+            return (row['max_id'] or 0) == self._max_id
+
+    def _add(self, row):
+        tree = self._trees.setdefault(row['type'], IntervalTree())
+        tree.insert(effective_start(row), naive_utc(row['end_time']), row['id'], row)
+        self._rows[row['id']] = row
+        self._max_id = max(self._max_id, row['id'])
+
+    def add(self, row):
+        with self._lock:
+            self._seen.expect()
+            if row['id'] not in self._rows:
+                self._add(row)
+
+    def remove(self, id):
+        with self._lock:
+            row = self._rows.pop(id, None)
+            if row is None:
+                return
+
+            self._seen.expect()
+            self._trees[row['type']].remove(effective_start(row), id)
+
+            if id == self._max_id:
+                self._max_id = max(self._rows, default=0)
+
+    def colliding(self, start, end, type):
+        """ reservations of `type` colliding with [start, end], like the
+        SQL in app.test_reservation, ordered by id
+        """
+        with self._lock:
+            tree = self._trees.get(type)
+            if tree is None:
+                return []
+
+            rows = tree.overlapping(naive_utc(start), naive_utc(end))
+
+        return [dict(row) for row in sorted(rows, key=lambda r: r['id'])]
+
+
+def timeline(rows, start, end):
+    """ Sweeps reservations across the window [start, end].
+
+    Returns (segments, peak): segments are (from, to, reserved) with the
+    count reserved from each change point until the next, and peak is the
+    most reserved at any instant. As reservations are closed intervals, one
+    ending exactly when another starts counts towards peak at that instant.
+    """
+    start, end = naive_utc(start), naive_utc(end)
+
+    starts = {}
+    ends = {}
+
+    for row in rows:
+        lo = max(effective_start(row), start)
+        hi = min(naive_utc(row['end_time']), end)
+
+        if lo > hi:
+            continue
+
+        starts[lo] = starts.get(lo, 0) + int(row['count'])
+        ends[hi] = ends.get(hi, 0) + int(row['count'])
+
+    times = sorted(set(starts) | set(ends) | {start, end})
+
+    segments = []
+    level = 0
+    peak = 0
+
+    for t, next_t in zip(times, times[1:] + [None]):
+        level += starts.get(t, 0)
+        peak = max(peak, level)
+        level -= ends.get(t, 0)
+
+        if next_t is not None:
+            segments.append((t, next_t, level))
+
+    return segments, peak
+
+
+def peak_reserved(rows, start, end):
+    """ the most devices reserved at once by rows during [start, end] """
+    return timeline(rows, start, end)[1]
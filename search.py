@@ -0,0 +1,347 @@
+import bisect
+import heapq
+import threading
+import time
+
+from versions import Seen
+
+# fields of a user row that can be searched
+USER_FIELDS = ('id', 'email', 'fname', 'lname')
+
+# most results a search may ask for
+MAX_LIMIT = 1000
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _insert(ids, id):
+    """ adds id to a sorted list, usually on the end as ids only grow """
+    if not ids or ids[-1] < id:
+        ids.append(id)
+    else:
+        bisect.insort(ids, id)
+
+
+def _remove(ids, id):
+    i = bisect.bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+
+
+class PrefixIndex:
+    """ (text, key) pairs in a sorted list, so the keys whose text starts
+    with a prefix are found with two binary searches
+    """
+
+    def __init__(self, entries=()):
+        self._entries = sorted(entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, text, key):
+        bisect.insort(self._entries, (text, key))
+
+    def remove(self, text, key):
+        i = bisect.bisect_left(self._entries, (text, key))
+        if i < len(self._entries) and self._entries[i] == (text, key):
+            del self._entries[i]
+
+    def matching(self, prefix):
+        """ (text, key) pairs whose text starts with prefix, in text order """
+        i = bisect.bisect_left(self._entries, (prefix,))
+        j = bisect.bisect_left(self._entries, (prefix + '\U0010ffff',), i)
+        return self._entries[i:j]
+
+    def starting_with(self, prefix):
+        """ keys whose text starts with prefix, in text order """
+        for _, key in self.matching(prefix):
+            yield key
+
+
+class UserSearch:
+    """ Users kept in memory with an index of the trigrams of each field,
+    so a substring search reads a few id lists instead of scanning the
+    user table. Searches shorter than three characters match from the
+    start of a field instead, using a PrefixIndex.
+
+    Matches are ranked by how well each field matched: exactly, at its
+    start or anywhere in it. Case is ignored.
+
+    Like reservations.ReservationIndex, rows are loaded on first use, kept
+    up to date by add() and remove() as this process writes, and reloaded
+    when the user table's change counter (see versions.TableVersions)
+    shows another process wrote, or every `refresh` seconds.
+    """
+
+    def __init__(self, refresh=300):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._rows = {}                                          # id -> row
+        self._texts = {}                                         # id -> field -> lower case text
+        self._trigrams = {field: {} for field in USER_FIELDS}    # field -> trigram -> sorted ids
+        self._prefixes = {field: PrefixIndex() for field in USER_FIELDS}
+        self._seen = Seen()
+        self.loaded_at = None
+
+    @property
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded_at = None
+
+    def load(self, cursor, version=None):
+        """ loads every user. version is the table's counter, read before
+        the rows so a write in between triggers another load
+        """
+        cursor.execute(""" SELECT id, email, fname, lname, type, created_at FROM user ORDER BY id; """)
+        rows = cursor.fetchall()
+
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add(row)
+            self._seen.reset(version)
+            self.loaded_at = time.monotonic()
+
+    def is_current(self, version):
+        """ whether only this process has written users since the load,
+        from the change counter alone, so searching never queries
+        """
+        with self._lock:
+            return self._seen.matches(version)
+
+    def _add(self, row):
+        id = row['id']
+        texts = {field: str(row[field] or '').lower() for field in USER_FIELDS}
+
+        self._rows[id] = row
+        self._texts[id] = texts
+
+        for field, text in texts.items():
+            postings = self._trigrams[field]
+            for gram in _trigrams(text):
+                _insert(postings.setdefault(gram, []), id)
+            self._prefixes[field].add(text, id)
+
+    def add(self, rows):
+        """ adds the users one request inserted """
+        with self._lock:
+            self._seen.expect()
+            for row in rows:
+                if row['id'] not in self._rows:
+                    self._add(row)
+
+    def remove(self, id):
+        with self._lock:
+            row = self._rows.pop(id, None)
+            if row is None:
+                return
+
+            self._seen.expect()
+            for field, text in self._texts.pop(id).items():
+                postings = self._trigrams[field]
+                for gram in _trigrams(text):
+                    _remove(postings[gram], id)
+                    if not postings[gram]:
+                        del postings[gram]
+                self._prefixes[field].remove(text, id)
+
+    def _inside(self, field, text):
+        """ yields, lowest first, the ids with text in field other than at
+        its start, reading the shortest id list of its trigrams
+        """
+        postings = self._trigrams[field]
+        lists = [postings.get(gram) for gram in _trigrams(text)]
+        if not all(lists):
+            return
+
+        texts = self._texts
+        for id in min(lists, key=len):
+            if texts[id][field].find(text) > 0:
+                yield id
+
+    def search(self, terms, limit=50):
+        """ rows matching any of terms, a {field: text} dict, best first.
+        Each field scores 3 for an exact match, 2 for a match at its start
+        and 1 for one anywhere else; ties go to the lowest id.
+
+        Matches at the start come from the PrefixIndexes and are all
+        scored. The rest are read in id order, stopping once no later id
+        could score enough to be in the first `limit`, so a term found in
+        every row costs no more than one found in `limit` of them.
+        """
+        terms = [(field, text.lower()) for field, text in terms.items()]
+        inside = [(field, text) for field, text in terms if len(text) >= 3]
+
+        with self._lock:
+            texts = self._texts
+            scores = {}  # id -> score
+
+            for field, text in terms:
+                for value, id in self._prefixes[field].matching(text):
+                    scores[id] = scores.get(id, 0) + (3 if value == text else 2)
+
+            if inside:
+                for id in scores:
+                    scores[id] += sum(1 for field, text in inside if texts[id][field].find(text) > 0)
+
+            counts = {}  # score -> ids with it
+            for score in scores.values():
+                counts[score] = counts.get(score, 0) + 1
+
+            # a heap of (id, stream) merging each field's matches in id order
+            streams = [self._inside(field, text) for field, text in inside]
+            heap = [(id, i) for i, id in enumerate(next(stream, None) for stream in streams) if id is not None]
+            heapq.heapify(heap)
+
+            upfront = {}  # score -> sorted ids with it, of the matches at the start
+            if heap:
+                for id in sorted(scores):
+                    upfront.setdefault(scores[id], []).append(id)
+
+            while heap and not _filled(counts, upfront, limit, len(heap), heap[0][0]):
+                id = heap[0][0]
+                while heap and heap[0][0] == id:
+                    _, i = heapq.heappop(heap)
+                    following = next(streams[i], None)
+                    if following is not None:
+                        heapq.heappush(heap, (following, i))
+
+                if id not in scores:
+                    score = sum(1 for field, text in inside if texts[id][field].find(text) > 0)
+                    scores[id] = score
+                    counts[score] = counts.get(score, 0) + 1
+
+            best = heapq.nsmallest(limit, scores, key=lambda id: (-scores[id], id))
+            return [dict(self._rows[id]) for id in best]
+
+
+def _filled(counts, upfront, limit, most, next):
+    """ whether `limit` of the ids counted in counts would rank ahead of
+    any id from next on, which scores at most `most`: by scoring more, or
+    the same with a lower id.
+
+    Ids read from the streams are all below next, so only those scored up
+    front can be at or above it.
+    """
+    ahead = sum(n for score, n in counts.items() if score > most)
+    if most in counts:
+        later = upfront.get(most, ())
+        ahead += counts[most] - (len(later) - bisect.bisect_left(later, next))
+    return ahead >= limit
+
+
+def user_terms(row):
+    return [row['fname'], row['lname'], '{} {}'.format(row['fname'], row['lname']),
+            row['email'], str(row['id'])]
+
+
+def device_terms(row):
+    return [row['serial_no'], str(row['id'])]
+
+
+class Suggestions:
+    """ Typeahead for one table: the words people type into lookup boxes,
+    given by terms(row), in a PrefixIndex pointing back at the rows.
+
+    Once loaded, suggest() never touches the database. Writes in this
+    process are applied with add() and remove(); writes by other
+    processes show up after the reload every `refresh` seconds.
+    """
+
+    def __init__(self, table, columns, terms, refresh=300):
+        self.table = table
+        self.columns = columns
+        self.terms = terms
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._rows = {}     # id -> (row, texts)
+        self._index = PrefixIndex()
+        self.loaded_at = None
+
+    @property
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh
+
+    def load(self, cursor):
+        cursor.execute(""" SELECT {} FROM `{}`; """.format(
+            ', '.join('`{}`'.format(c) for c in self.columns), self.table))
+        rows = cursor.fetchall()
+
+        entries = {row['id']: (row, self._texts(row)) for row in rows}
+        index = PrefixIndex((text, id) for id, (_, texts) in entries.items() for text in texts)
+
+        with self._lock:
+            self._rows = entries
+            self._index = index
+            self.loaded_at = time.monotonic()
+
+    def _texts(self, row):
+        return sorted({str(text).lower() for text in self.terms(row) if text})
+
+    def add(self, row):
+        row = {c: row.get(c) for c in self.columns}
+        texts = self._texts(row)
+
+        with self._lock:
+            if row['id'] in self._rows:
+                return
+            self._rows[row['id']] = (row, texts)
+            for text in texts:
+                self._index.add(text, row['id'])
+
+    def remove(self, id):
+        with self._lock:
+            row, texts = self._rows.pop(id, (None, ()))
+            for text in texts:
+                self._index.remove(text, id)
+
+    def suggest(self, prefix, limit=10):
+        """ up to limit rows with a term starting with prefix, in order of
+        the term, so an exact match comes first
+        """
+        prefix = prefix.lower()
+        found = {}
+
+        with self._lock:
+            for id in self._index.starting_with(prefix):
+                found.setdefault(id, None)
+                if len(found) >= limit:
+                    break
+
+            return [dict(self._rows[id][0]) for id in found]
+
+
+if __name__ == '__main__':
+    import random
+    import string
+    import timeit
+    from datetime import datetime
+
+    print('Benchmarking user search')
+
+    random.seed(1)
+
+    def word(n):
+        return ''.join(random.choice(string.ascii_lowercase) for _ in range(n))
+
+    users = UserSearch()
+    for i in range(1, 50001):
+        fname, lname = word(random.randint(3, 8)).title(), word(random.randint(4, 10)).title()
+        users._add(dict(id=i, email='{}.{}@school.example'.format(fname, lname).lower(),
+                        fname=fname, lname=lname, type=0, created_at=datetime(2016, 9, 1)))
+
+    for terms in ({'fname': 'jo'}, {'lname': 'smi'}, {'fname': 'abc', 'lname': 'abc'},
+                  {'email': 'school'}, {'id': '123'},
+                  {field: 'school' for field in USER_FIELDS}, {field: 'e' for field in USER_FIELDS}):
+        n = 200
+        seconds = timeit.timeit(lambda: users.search(terms), number=n) / n
+        print('{:40} {:3} results  {:.2f} ms'.format(str(terms), len(users.search(terms)), seconds * 1000))
@@ -0,0 +1,65 @@
+import random
+import unittest
+
+from search import USER_FIELDS, UserSearch
+
+
+def user(id, fname, lname):
+    return dict(id=id, email='{}.{}@school.example'.format(fname, lname), fname=fname, lname=lname,
+                type=0, created_at=None)
+
+
+def ranked(rows, terms, limit):
+    """ UserSearch.search worked out row by row """
+    scores = {}
+    for id, row in rows.items():
+        score = 0
+        for field, text in terms.items():
+            text, value = text.lower(), str(row[field] or '').lower()
+            if value == text:
+                score += 3
+            elif value.startswith(text):
+                score += 2
+            elif len(text) >= 3 and value.find(text) > 0:
+                score += 1
+        if score:
+            scores[id] = score
+    return sorted(scores, key=lambda id: (-scores[id], id))[:limit]
+
+
+class UserSearchTest(unittest.TestCase):
+
+    def test_tie_with_a_later_lower_id(self):
+        """ a row matching inside two fields ties a higher id matching at
+        the start of one, and comes first for its lower id
+        """
+        users = UserSearch()
+        users._add(user(1, 'xeda', 'xbce'))
+        users._add(user(5, 'zz', 'ddz'))
+
+        terms = {'lname': 'dd', 'fname': 'eda', 'email': 'bce'}
+        self.assertEqual([row['id'] for row in users.search(terms, limit=1)], [1])
+
+    def test_matches_brute_force(self):
+        random.seed(3)
+
+        def word(n):
+            return ''.join(random.choice('abcde') for _ in range(n))
+
+        users = UserSearch()
+        rows = {}
+        for id in range(1, 1001):
+            rows[id] = user(id, word(random.randint(2, 6)), word(random.randint(2, 6)))
+            users._add(rows[id])
+
+        for _ in range(3000):
+            terms = {field: random.choice([word(random.randint(1, 3)), word(3), 'exa', str(random.randint(1, 999))])
+                     for field in random.sample(USER_FIELDS, random.randint(1, 4))}
+            limit = random.randint(1, 60)
+
+            self.assertEqual([row['id'] for row in users.search(terms, limit)], ranked(rows, terms, limit),
+                             (terms, limit))
+
+
+if __name__ == '__main__':
+    unittest.main()
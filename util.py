@@ -1,9 +1,12 @@
+import bisect
 from datetime import datetime
 from datetime import timedelta
 import json
 from json import JSONEncoder
+import io
 import qrcode
 import os
+import threading
 from datetime import timezone
 
 date_keys = ['created_at', 'start_time', 'end_time', 'last_modified']
@@ -11,14 +14,31 @@ date_keys = ['created_at', 'start_time', 'end_time', 'last_modified']
 def SQL_one_line(sql):
     return ' '.join(sql.replace('\n', ' ').split())
 
-def dict_dates_to_utc(list_of_dict):    
-    for d in list_of_dict:        
-        for key, value in d.items():
-            if key in date_keys:         
-                d[key] = d[key].replace(tzinfo=timezone.utc)
-               
+def dict_dates_to_utc(list_of_dict):
+    """ Marks the date_keys columns of rows from one query as UTC, in place.
 
-def make_qr(user_id: int, path) -> None:
+    The rows share their columns, so which ones hold dates is worked out
+    once from the first row and each column is converted in one pass.
+    """
+    if not list_of_dict:
+        return
+
+    utc = timezone.utc
+
+    for key in [key for key in list_of_dict[0] if key in date_keys]:
+        for d in list_of_dict:
+            value = d[key]
+            if value is not None:
+                d[key] = value.replace(tzinfo=utc)
+
+
+def date_indices(columns):
+    """ positions of the date_keys columns, e.g. from cursor.column_names """
+    return [i for i, column in enumerate(columns) if column in date_keys]
+
+
+def qr_png(user_id: int) -> bytes:
+    """ the PNG of a user or device id's QR code """
     qr = qrcode.QRCode(
         version=None,
         error_correction=qrcode.constants.ERROR_CORRECT_H,
@@ -28,9 +48,29 @@ def make_qr(user_id: int, path) -> None:
     qr.add_data(str(user_id))
     qr.make(fit=True)
 
-    name = '{}.png'.format(user_id)
+    buffer = io.BytesIO()
+    qr.make_image().get_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_qr(user_id: int, path, overwrite=False) -> None:
+    """ writes <user_id>.png to path, unless it is already there """
+    name = os.path.join(path, '{}.png'.format(user_id))
+
+    if not overwrite and os.path.exists(name):
+        return
+
+    write_atomic(name, qr_png(user_id))
+
+
+def write_atomic(name, data: bytes) -> None:
+    """ writes a file so readers never see it half written """
+    temp = '{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident())
 
-    qr.make_image().get_image().save(os.path.join(path, name))
+    with open(temp, 'wb') as f:
+        f.write(data)
+
+    os.replace(temp, name)
 
 
 class DateTimeEncoder(JSONEncoder):
@@ -46,17 +86,280 @@ class DateTimeEncoder(JSONEncoder):
             return JSONEncoder.default(self, obj)
 
 
+# one encoder for every call, json.dumps(cls=...) would build a new one each time
+_stdlib_encoder = DateTimeEncoder()
+
+
+def _default(obj):
+    """ default() for the fast backends, which convert datetimes themselves """
+    if isinstance(obj, timedelta):
+        return str(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+# name -> (encode function, separator between list items)
+json_backends = {
+    'stdlib': (_stdlib_encoder.encode, ', '),
+}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    json_backends['orjson'] = (lambda obj: orjson.dumps(obj, default=_default).decode(), ',')
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    json_backends['ujson'] = (lambda obj: ujson.dumps(obj, default=_default, escape_forward_slashes=False), ',')
+
+_encode, _separator = json_backends['stdlib']
+_text_dates = True
+
+
+def _as_text(value):
+    """ value as DateTimeEncoder writes it """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return str(value)
+    return value
+
+
+def _dates_as_text(rows):
+    """ rows from one query with their datetime and timedelta values
+    already the strings DateTimeEncoder would write, so the C encoder
+    never calls back into default(). Dict rows are changed in place.
+
+    Which columns to convert is worked out from the first row, and each
+    distinct value is formatted once, as reservations share a few start
+    and end times. Aware datetimes are equal across time zones, so a
+    remembered text is only used for a value in the same tzinfo.
+    """
+    first = rows[0]
+    keys = first.keys() if isinstance(first, dict) else range(len(first))
+    keys = [k for k in keys if isinstance(first[k], (datetime, timedelta))
+            or (isinstance(first, dict) and k in date_keys)]
+
+    if not keys:
+        return rows
+
+    if not isinstance(first, dict):
+        rows = [list(row) for row in rows]
+
+    for k in keys:
+        texts = {}  # value -> (tzinfo, text)
+        for row in rows:
+            value = row[k]
+            if value is None:
+                continue
+
+            tzinfo = getattr(value, 'tzinfo', None)
+            known = texts.get(value)
+            if known is None or known[0] is not tzinfo:
+                known = texts[value] = (tzinfo, _as_text(value))
+            row[k] = known[1]
+
+    return rows
+
+
+def set_json_backend(name):
+    """ Picks the encoder behind encode_json: 'stdlib', 'orjson', 'ujson' or
+    'auto' for the fastest one installed.
+
+    Only 'stdlib' gives exactly the bytes older versions sent. The others
+    write compact separators and raw UTF-8, which any JSON parser reads the
+    same but which differ byte for byte.
+    """
+    global _encode, _separator, _text_dates
+
+    if name == 'auto':
+        name = next(n for n in ('orjson', 'ujson', 'stdlib') if n in json_backends)
+
+    _encode, _separator = json_backends[name]
+    _text_dates = name == 'stdlib'  # the others format datetimes natively
+    return name
+
+
 def encode_json(obj):
     """ Will encode datetime to ISO string for JSON serialisation"""
-    return json.dumps(obj, cls=DateTimeEncoder)
+    return _encode(obj)
+
+
+def fetch_chunks(cursor, size=500):
+    """ Yields lists of up to size rows until the cursor is exhausted"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def encode_json_envelope(chunks, extra=None, columns=None):
+    """ Yields {"success": true, "data": [...]} a piece at a time, where the
+    data list is every row from an iterable of row lists. The output is the
+    same as encode_json of the whole envelope.
+
+    With columns, rows are sequences and the data is columnar instead:
+    {"columns": [...], "rows": [[...], ...]}.
+
+    extra() may return more keys for the envelope, it is called once every
+    row has been sent.
+    """
+    envelope = Envelope(columns)
+
+    yield envelope.head()
+
+    for rows in chunks:
+        text = envelope.rows(rows)
+        if text:
+            yield text
+
+    yield envelope.tail(extra() if extra is not None else None)
 
 
-def parse_range(a_str):
-    result=set()
+class Envelope:
+    """ The pieces of encode_json_envelope, for callers that can't hand it
+    an iterable, e.g. ones awaiting each chunk
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.first = True
+
+    def head(self):
+        if self.columns is None:
+            return encode_json({'success': True, 'data': []})[:-2]
+        return encode_json({'success': True, 'data': {'columns': list(self.columns), 'rows': []}})[:-3]
+
+    def rows(self, rows):
+        """ a chunk of rows in one call, without its [ and ] """
+        if not rows:
+            return ''
+
+        if _text_dates:
+            rows = _dates_as_text(rows)
+
+        text = encode_json(rows)[1:-1]
+        if not self.first:
+            text = _separator + text
+        self.first = False
+        return text
+
+    def tail(self, more=None):
+        text = ']' if self.columns is None else ']}'
+        if more:
+            text += _separator + encode_json(more)[1:-1]
+        return text + '}'
+
+
+# most ids a selection string may pick
+MAX_SELECTION = 100000
+
+
+class Selection:
+    """ Ids picked by a string like '1-5, 34', held as sorted, merged runs
+    of (first, last), so '1-500000' is one pair rather than half a million
+    ints. Iterating gives the ids in order.
+    """
+
+    def __init__(self, runs):
+        self.runs = runs
+
+    def __iter__(self):
+        for first, last in self.runs:
+            yield from range(first, last + 1)
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.runs)
+
+    def __contains__(self, id):
+        i = bisect.bisect_right(self.runs, (id, float('inf'))) - 1
+        return i >= 0 and self.runs[i][0] <= id <= self.runs[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, Selection) and self.runs == other.runs
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else '{}-{}'.format(first, last)
+                        for first, last in self.runs)
+
+    def __repr__(self):
+        return "Selection('{}')".format(self)
+
+    def chunks(self, size):
+        """ splits into selections of at most size ids each """
+        runs = []
+        count = 0
+
+        for first, last in self.runs:
+            while first <= last:
+                end = min(last, first + size - count - 1)
+                runs.append((first, end))
+                count += end - first + 1
+                first = end + 1
+
+                if count == size:
+                    yield Selection(runs)
+                    runs = []
+                    count = 0
+
+        if runs:
+            yield Selection(runs)
+
+    def where(self, column):
+        """ (sql, params) matching these ids in column, with a BETWEEN for
+        each run and one IN for the single ids
+        """
+        clauses = []
+        params = []
+        singles = []
+
+        for first, last in self.runs:
+            if first == last:
+                singles.append(first)
+            else:
+                clauses.append('`{}` BETWEEN %s AND %s'.format(column))
+                params += [first, last]
+
+        if singles:
+            clauses.append('`{}` IN ({})'.format(column, ', '.join(['%s'] * len(singles))))
+            params += singles
+
+        if not clauses:
+            return 'FALSE', []
+
+        return '(' + ' OR '.join(clauses) + ')', params
+
+
+def parse_range(a_str, limit=MAX_SELECTION):
+    """ a Selection from a string like '1-5, 34'. Backwards ranges such as
+    '20-5' pick nothing. Raises ValueError if it can't be read or picks
+    more than limit ids.
+    """
+    parts = []
     for part in a_str.split(','):
-        x=part.split('-')
-        result.update(range(int(x[0]),int(x[-1])+1))
-    return sorted(result)
+        x = part.split('-')
+        first, last = int(x[0]), int(x[-1])
+        if first <= last:
+            parts.append((first, last))
+
+    runs = []
+    for first, last in sorted(parts):
+        if runs and first <= runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], max(runs[-1][1], last))
+        else:
+            runs.append((first, last))
+
+    selection = Selection(runs)
+
+    if len(selection) > limit:
+        raise ValueError('selection has more than {} ids'.format(limit))
+
+    return selection
 
 if __name__ == "__main__":
 
@@ -75,5 +378,65 @@ if __name__ == "__main__":
     ranges = '1-5, 34', '45, 1', '20-5', '5-20'
 
     for i in ranges:
-        print(i, '->', parse_range(i))
+        print(i, '->', parse_range(i), list(parse_range(i)))
+
+    print('1-500000, 7, 9-12 ->', parse_range('1-500000, 7, 9-12', limit=10 ** 6).where('id'))
+
+    print('Benchmarking UTC normalisation')
+
+    import timeit
+
+    def per_key(list_of_dict):
+        # how dict_dates_to_utc used to work
+        for d in list_of_dict:
+            for key, value in d.items():
+                if key in date_keys:
+                    d[key] = d[key].replace(tzinfo=timezone.utc)
+
+    def make_rows():
+        return [{'id': i,
+                 'start_time': datetime(2016, 9, 1, 9, 0),
+                 'end_time': datetime(2016, 9, 1, 10, 30),
+                 'class_id': 12,
+                 'type': 'ipad',
+                 'count': 25,
+                 'user_id': 1044,
+                 'safe_zone': timedelta(hours=1)} for i in range(100000)]
+
+    for name, function in (('per key', per_key), ('column-wise', dict_dates_to_utc)):
+        rows = make_rows()
+        seconds = timeit.timeit(lambda: function(rows), number=1)
+        print('{:>12}: {:.1f} ms for {} rows'.format(name, seconds * 1000, len(rows)))
+
+    print('Benchmarking JSON backends')
+
+    term_start = datetime(2016, 9, 1, 9, 0, tzinfo=timezone.utc)
+
+    def make_reservations():
+        # a term of 15 minute slots, so times repeat as they do in real data
+        return [{'id': i,
+                 'start_time': term_start + timedelta(minutes=15 * (i % 300)),
+                 'end_time': term_start + timedelta(minutes=15 * (i % 300) + 90),
+                 'class_id': 12,
+                 'type': 'ipad',
+                 'count': 25,
+                 'user_id': 1044,
+                 'safe_zone': timedelta(hours=i % 3)} for i in range(1000)]
+
+    reference = json.dumps({'success': True, 'data': make_reservations()}, cls=DateTimeEncoder)
+
+    n = 20
+    rows = make_reservations()
+    seconds = timeit.timeit(lambda: [json.dumps(row, cls=DateTimeEncoder) for row in rows], number=n)
+    print('json.dumps per row: {:.2f} us/row'.format(seconds / n / len(rows) * 1e6))
+
+    for name in json_backends:
+        set_json_backend(name)
+
+        # encoding changes the rows, so each run gets its own
+        chunks = iter([make_reservations() for _ in range(n + 1)])
+        seconds = timeit.timeit(lambda: ''.join(encode_json_envelope([next(chunks)])), number=n)
+        same = ''.join(encode_json_envelope([next(chunks)])) == reference
+        print('{:>8}: {:.2f} us/row, identical output: {}'.format(
+            name, seconds / n / len(rows) * 1e6, same))
 
@@ -0,0 +1,127 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+# tables with a change counter, new ones go on the end
+TABLES = ('user', 'device', 'class', 'class_registration', 'reservation',
+          'device_type_privilage', 'lateness', 'event')
+
+# each slot is (counter, changed_at), slot 0 holds a random epoch instead
+_SLOT = struct.Struct('<Qd')
+
+
+class TableVersions:
+    """ A change counter per table, shared by every server process through
+    a small memory-mapped file in the spool.
+
+    Write routes bump the tables they change, so anything read from some
+    tables is still current while their counters haven't moved. Writes
+    made outside the app aren't seen, which is why caches built on these
+    also expire.
+
+    The file starts with a random epoch, so counters which start again
+    from zero in a new file never repeat an old version.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._map = None
+        self._open_lock = threading.Lock()
+
+    def _open(self):
+        """ maps the file on first use, so importing the app opens nothing """
+        with self._open_lock:
+            if self._map is not None:
+                return
+
+            size = _SLOT.size * (len(TABLES) + 1)
+
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with self._locked():
+                if os.fstat(self._fd).st_size < size:
+                    os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size)
+
+                if self._read(0)[0] == 0:
+                    _SLOT.pack_into(self._map, 0, struct.unpack('<Q', os.urandom(8))[0] or 1, time.time())
+
+    @property
+    def epoch(self):
+        if self._map is None:
+            self._open()
+        return self._read(0)[0]
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read(self, slot):
+        return _SLOT.unpack_from(self._map, slot * _SLOT.size)
+
+    def bump(self, *tables):
+        """ records that tables have changed """
+        now = time.time()
+        if self._map is None:
+            self._open()
+        with self._locked():
+            for table in tables:
+                slot = TABLES.index(table) + 1
+                count, _ = self._read(slot)
+                _SLOT.pack_into(self._map, slot * _SLOT.size, count + 1, now)
+
+    def get(self, *tables):
+        """ the counters of tables, a tuple which changes whenever any of them does """
+        return (self.epoch,) + tuple(self._read(TABLES.index(table) + 1)[0] for table in tables)
+
+    def changed_at(self, *tables):
+        """ the latest time any of tables was bumped, or when counting
+        started if none have been
+        """
+        if self._map is None:
+            self._open()
+        return max(self._read(slot)[1] for slot in [0] + [TABLES.index(table) + 1 for table in tables])
+
+
+class Seen:
+    """ The version of a table an in-memory index was loaded at, so it can
+    tell whether anyone else has written since without asking the database.
+
+    The index applies this process's own writes straight away, before
+    after_request bumps the counter, so each is noted with expect() and
+    allowed for. Any other difference, or a write noted but never bumped,
+    means the index must be loaded again.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.pending = 0
+
+    def reset(self, version=None):
+        self.version = version
+        self.pending = 0
+
+    def expect(self):
+        """ notes a write of ours whose bump is still to come """
+        self.pending += 1
+
+    def matches(self, version):
+        """ whether version is the one loaded plus our own writes, catching
+        up to it if so
+        """
+        if self.version is None or version[:-1] != self.version[:-1]:
+            return False
+
+        if version[-1] != self.version[-1] + self.pending:
+            return False
+
+        self.reset(version)
+        return True
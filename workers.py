@@ -0,0 +1,157 @@
+import mimetypes
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import bcrypt
+
+import config
+import metrics
+from log import log
+from util import make_qr, qr_png
+
+# finished background tasks as (kind, key, future), drained by _collector
+completed = queue.Queue()
+
+_hash_pool = None
+_job_pool = None
+_qr_pool = None
+_collector = None
+_lock = threading.Lock()
+
+
+def hash_password(password):
+    """ bcrypt hash of a password, runs in a worker process """
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+
+
+def verify_password(password, hashed):
+    """ bcrypt check of a password against its stored hash, runs in a
+    worker process
+    """
+    return bcrypt.checkpw(password.encode('ascii'), hashed.encode('ascii'))
+
+
+def hash_pool():
+    """ processes for bcrypt, so hashing uses every core instead of
+    competing with request threads
+    """
+    global _hash_pool
+
+    with _lock:
+        if _hash_pool is None:
+            # spawn, as forking a threaded server can copy held locks
+            _hash_pool = ProcessPoolExecutor(max_workers=config.workers.get('hash_processes'),
+                                             mp_context=multiprocessing.get_context('spawn'))
+    return _hash_pool
+
+
+def job_pool():
+    """ processes for long running bulk jobs, kept apart from hash_pool
+    so a big job can't hold up people signing up
+    """
+    global _job_pool
+
+    with _lock:
+        if _job_pool is None:
+            _job_pool = ProcessPoolExecutor(max_workers=config.workers.get('job_processes'),
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _job_pool
+
+
+def qr_files(ids, path, overwrite=False):
+    """ writes QR codes for ids to path, runs in a worker process.
+    returns {id: error} for those that failed
+    """
+    failures = {}
+    for i in ids:
+        try:
+            make_qr(i, path, overwrite=overwrite)
+        except Exception as e:
+            failures[i] = str(e)
+    return failures
+
+
+def qr_pngs(ids):
+    """ QR code PNG bytes for ids, runs in a worker process.
+    returns ({id: png}, {id: error})
+    """
+    pngs = {}
+    failures = {}
+    for i in ids:
+        try:
+            pngs[i] = qr_png(i)
+        except Exception as e:
+            failures[i] = str(e)
+    return pngs, failures
+
+
+def render_pdf(html, static_path):
+    """ PDF bytes for a page of HTML from the app's templates, runs in a
+    worker process. /static/ URLs are read from static_path, drawing QR
+    codes which don't exist yet, as the app isn't there to serve them.
+    """
+    from weasyprint import HTML, default_url_fetcher
+
+    root = os.path.realpath(static_path)
+    qr_path = os.path.join(root, 'img', 'qr')
+
+    def fetch(url):
+        path = urlsplit(url).path
+        if not path.startswith('/static/'):
+            return default_url_fetcher(url)
+
+        name = os.path.realpath(os.path.join(root, path[len('/static/'):]))
+        if not name.startswith(root + os.sep):
+            raise ValueError('{} is outside static'.format(url))
+
+        stem, extension = os.path.splitext(os.path.basename(name))
+        if os.path.dirname(name) == qr_path and extension == '.png' and stem.isdigit():
+            make_qr(int(stem), qr_path)
+
+        with open(name, 'rb') as f:
+            return dict(string=f.read(), mime_type=mimetypes.guess_type(name)[0])
+
+    return HTML(string=html, base_url='http://localhost/', url_fetcher=fetch).write_pdf()
+
+
+def qr_pool():
+    """ threads for PNG encoding and writing, which is mostly I/O """
+    global _qr_pool, _collector
+
+    with _lock:
+        if _qr_pool is None:
+            _qr_pool = ThreadPoolExecutor(max_workers=config.workers.get('qr_threads', 2))
+            _collector = threading.Thread(name='completed', target=_collect)
+            _collector.daemon = True
+            _collector.start()
+    return _qr_pool
+
+
+def _collect():
+    while True:
+        kind, key, future = completed.get()
+        error = future.exception()
+
+        if error is not None:
+            log.error('[{}] {} failed: {}'.format(kind, key, error))
+
+
+def hash_passwords(passwords):
+    """ hashes many passwords in parallel, keeping their order """
+    return list(hash_pool().map(hash_password, passwords))
+
+
+def _timed_make_qr(i, path):
+    with metrics.QR_SECONDS.time('background'):
+        make_qr(i, path)
+
+
+def submit_qr(ids, path):
+    """ makes QR codes in the background, the caller does not wait """
+    for i in ids:
+        future = qr_pool().submit(_timed_make_qr, i, path)
+        future.add_done_callback(lambda f, i=i: completed.put(('qr', i, f)))